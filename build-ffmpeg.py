@@ -2,9 +2,10 @@
 """
 Build a minimal ffmpeg.exe for rigdio's loudness analysis.
 
-Rigdio only uses: ffmpeg -i <file> -af volumedetect -f null -
-So we only need a handful of decoders, the volumedetect filter,
-and file protocol support. This produces an ffmpeg.exe around 10-20 MB
+Rigdio only uses: ffmpeg -i <file> -af volumedetect[,ebur128] -f null -
+and (for the pcm loudness backend) ffmpeg -i <file> [-af ebur128] -f s16le -
+So we only need a handful of decoders, the volumedetect and ebur128 filters,
+and file/pipe protocol support. This produces an ffmpeg.exe around 10-20 MB
 instead of the full ~140 MB.
 
 This script automatically installs MSYS2 and all required packages if
@@ -56,19 +57,19 @@ PARSERS = [
     "mpegaudio", "aac", "ac3", "flac", "opus", "vorbis",
 ]
 
-# Only the volumedetect filter is needed
+# volumedetect for the mean volume, ebur128 for integrated loudness and true peak (level: measure: lufs)
 FILTERS = [
-    "volumedetect", "anull", "aresample",
+    "volumedetect", "ebur128", "anull", "aresample",
 ]
 
-# Only file protocol
+# File protocol, plus pipe for streaming PCM to the pcm loudness backend
 PROTOCOLS = [
-    "file",
+    "file", "pipe",
 ]
 
-# Muxers needed (null for -f null output)
+# Muxers needed (null for -f null output, s16le for raw PCM output)
 MUXERS = [
-    "null",
+    "null", "s16le",
 ]
 
 # Encoders needed (pcm_s16le is required by the null muxer)
@@ -0,0 +1,106 @@
+import os
+import json
+import zlib
+import hashlib
+import threading
+from os.path import dirname, isfile
+
+from loudness import fileStamp
+
+# first line of every bundle; changed whenever the layout changes, so old bundles are ignored
+BUNDLE_MAGIC = b"rigdio team bundle 1\n"
+
+# only one bundle is written at a time; both a load and its loudness analysis may write one
+_bundle_lock = threading.Lock()
+
+def bundleName (filename):
+   """Returns the name of the compiled bundle for a .4ccm file (team.4ccm -> team.4ccmc)."""
+   return filename + "c"
+
+def _stamp (fullpath):
+   try:
+      return list(fileStamp(fullpath))
+   except OSError:
+      return None
+
+def _folderStamp (folder):
+   # hash of the file names in the folder; its mtime can't be used, since writing a bundle changes it
+   try:
+      names = sorted(name for name in os.listdir(folder) if not name.endswith((".4ccmc", ".tmp")))
+   except OSError:
+      return None
+   return hashlib.blake2b("\n".join(names).encode("utf8"), digest_size=16).hexdigest()
+
+def compileBundle (filename, normalize, tname, sync, entries, songs, measurements):
+   """
+      Returns the compiled form of a team export, ready for writeBundle().
+
+      It holds the parsed entries (see rigparse.SongEntry.toData()), the song file each one resolved
+      to and the loudness measurements known so far, stamped with the size and mtime of every file
+      involved so that isCurrent() can tell when any of them changed.
+   """
+   return {
+      "export" : _stamp(filename),
+      "folder" : _folderStamp(dirname(filename) or "."),
+      "normalize" : bool(normalize),
+      "tname" : tname,
+      "sync" : sync,
+      "entries" : entries,
+      "songs" : [[song, _stamp(song)] for song in songs],
+      "loudness" : measurements
+   }
+
+def bundleSongs (data):
+   """Returns the song file of every entry in a compiled team."""
+   return [song for song, stamp in data["songs"]]
+
+def isCurrent (data, filename, normalize):
+   """Checks that none of the files a compiled team was made from changed since."""
+   # songs are resolved differently depending on normalize_volume (see rigparse.songCheck)
+   if data["normalize"] != bool(normalize):
+      return False
+   if data["export"] != _stamp(filename):
+      return False
+   # a new or renamed file in the folder can change which file a song resolves to
+   if data["folder"] != _folderStamp(dirname(filename) or "."):
+      return False
+   return all(_stamp(song) == stamp for song, stamp in data["songs"])
+
+def writeBundle (filename, data):
+   """
+      Saves a compiled team next to its .4ccm file.
+
+      Bundles are zlib-compressed JSON rather than pickles, so opening a bundle from someone else's
+      team folder can't run code.
+   """
+   output = bundleName(filename)
+   with _bundle_lock:
+      temp = output + ".tmp"
+      try:
+         with open(temp, "wb") as f:
+            f.write(BUNDLE_MAGIC)
+            f.write(zlib.compress(json.dumps(data).encode("utf8")))
+         os.replace(temp, output)
+      except Exception as e:
+         print("Could not write team bundle {}: {}".format(output, e))
+         return False
+   print("Saved team bundle {}".format(output))
+   return True
+
+def readBundle (filename, normalize):
+   """Returns the compiled team saved for a .4ccm file, or None if there is none or it isn't current."""
+   name = bundleName(filename)
+   if not isfile(name):
+      return None
+   try:
+      with open(name, "rb") as f:
+         if f.readline() != BUNDLE_MAGIC:
+            print("Ignoring team bundle {} from another version of rigdio.".format(name))
+            return None
+         data = json.loads(zlib.decompress(f.read()).decode("utf8"))
+   except Exception as e:
+      print("Could not read team bundle {}: {}".format(name, e))
+      return None
+   if not isCurrent(data, filename, normalize):
+      return None
+   return data
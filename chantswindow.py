@@ -1,8 +1,9 @@
 from tkinter import *
 from config import settings
 from rigdio_util import volumeColor
+from legacy import dispatcher
 
-import os.path, threading, time, random
+import os.path, random
 
 # chants window class
 class chantswindow(Toplevel):
@@ -155,6 +156,8 @@ class ChantsButton:
 
       # how long a chant can be played for until it begins to fade out
       self.fadeOutTime = self.chantsManager.lastTimer
+      # scheduled chant timer fade, while a chant is playing
+      self.timeout = None
       self.playButton = Button(frame, text=self.text, command=self.playChant, bg=colours["home" if self.home else "away"])
 
    def playChant (self):
@@ -174,7 +177,7 @@ class ChantsButton:
          # otherwise, set this chant as the active chant and begin playing
          self.playButton.configure(relief=SUNKEN)
          self.chantsManager.activeChant = self.chant
-         self.chantEndCheck = threading.Thread(target=self.checkChantDone)
+         self.chantsManager.activeButton = self
          self.chant.reloadSong()
          self.chant.play()
          print("Chant now playing.")
@@ -185,47 +188,56 @@ class ChantsButton:
             if team is not None and hasattr(team, 'hasLouder') and team.hasLouder:
                team.startBlinking()
 
-         # while greying out the timer stuff and starting the chant end checker thread
+         # grey out the timer stuff, then wait for the chant to end or time out
          self.chantsManager.disableChantTimer(True, self.chantsManager.window.chantsFrame if self.chantsManager.window is not None else None)
-         self.chantEndCheck.start()
-
-   # checks when the chant is done or playing too long
-   def checkChantDone (self):
-      self.chantStart = time.time()
-      while self.chantEndCheck is not None:
-         # stops the thread early, before the song has finished playing
-         if self.chantsManager.endThreadEarly:
-            print("Chant ended early.")
-            # stops the song, resets the end thread bool, and enables the chant timer (bool reset and chant timer enable is for when new chants are loaded)
-            self.chant.fade = True
-            self.chant.fadeOut()
-            self.chantsManager.endThreadEarly = False
-            if self.frame.winfo_exists():
-               self.playButton.configure(relief=RAISED)
-               self.chantsManager.disableChantTimer(False, self.chantsManager.window.chantsFrame if self.chantsManager.window is not None else None)
-            # stop blinking if the chant was louder-marked
-            self._stopChantBlink()
-            # disables the fade, mark active chant as none, and kill the thread
-            self.chant.fade = None
-            self.chantsManager.activeChant = None
-            self.chantEndCheck = None
-
-         if self.chant.song.eof_reached:
-            self.chantDone()
-            self.chantEndCheck = None
+         self.chant.onEnd(self.chantEnded)
          # checks if the user is even using the timer in the first place as well
-         elif self.chantsManager.timerEnabled and (time.time() - self.chantStart) > self.fadeOutTime:
-            print("Chant timed out, fade starting.")
-            self.chant.fade = True
-            self.chant.fadeOut()
-            self.chantDone()
-            self.chantEndCheck = None
-         time.sleep(0.01)
+         if self.chantsManager.timerEnabled:
+            self.timeout = dispatcher.schedule(self.fadeOutTime, self.chantTimedOut)
+         else:
+            self.timeout = None
+
+   # stops waiting for the chant to end or time out
+   def stopChecks (self):
+      self.chant.removeEnd(self.chantEnded)
+      if self.timeout is not None:
+         self.timeout.cancel()
+         self.timeout = None
+
+   # runs on the dispatcher thread when the chant reaches the end of its file
+   def chantEnded (self, chant):
+      self.stopChecks()
+      self.chantDone()
+
+   # runs on the dispatcher thread when the chant has played for longer than the chant timer
+   def chantTimedOut (self):
+      self.timeout = None
+      self.stopChecks()
+      print("Chant timed out, fade starting.")
+      self.chant.pause(fade=True, callback=self.chantDone)
+
+   # stops the chant early, before the song has finished playing
+   def stopEarly (self):
+      self.stopChecks()
+      print("Chant ended early.")
+      self.chant.pause(fade=True, callback=self.earlyDone)
+
+   def earlyDone (self):
+      # enables the chant timer (for when new chants are loaded)
+      if self.frame.winfo_exists():
+         self.playButton.configure(relief=RAISED)
+         self.chantsManager.disableChantTimer(False, self.chantsManager.window.chantsFrame if self.chantsManager.window is not None else None)
+      # stop blinking if the chant was louder-marked
+      self._stopChantBlink()
+      # mark active chant as none
+      self.chantsManager.activeChant = None
+      self.chantsManager.activeButton = None
 
    # clears out the active chant variable once the chant is over
    def chantDone (self):
       if self.chantsManager.activeChant is not None:
          self.chantsManager.activeChant = None
+         self.chantsManager.activeButton = None
          print("Chant {} concluded.".format(self.text))
          if self.frame.winfo_exists():
             self.playButton.configure(relief=RAISED)
@@ -258,11 +270,9 @@ class ChantsManager:
       self.lastTimer = 30
       self.lastVolume = 100
 
-      # chant that is currently being played
+      # chant that is currently being played, and the button that played it
       self.activeChant = None
-
-      # used to end the checkChantDone thread early
-      self.endThreadEarly = False
+      self.activeButton = None
 
       # used to check if program is using the timer
       self.usingTimer = IntVar(value=settings.config["chant_timer_enabled_default"])
@@ -324,10 +334,10 @@ class ChantsManager:
       if (self.window is not None):
          self.window.chantsFrame.createChants(away = True)
 
-   # used to end the thread early, called by the main rigdio file when chants window is closed
+   # used to stop the active chant early, called by the main rigdio file when chants window is closed
    def endThread (self):
-      if self.activeChant is not None:
-         self.endThreadEarly = True
+      if self.activeChant is not None and self.activeButton is not None:
+         self.activeButton.stopEarly()
 
    # used to disable the use of the timer stuff when a chant is playing, to prevent the user from messing with it during a chant and causing problems
    def disableChantTimer(self, disable, frame=None):
@@ -1,4 +1,5 @@
 import threading
+import operator
 from time import sleep
 from os.path import basename, abspath, isfile
 
@@ -8,10 +9,19 @@ from tkinter.simpledialog import Dialog
 import tkinter.messagebox as messagebox
 
 from config import settings
-from rigdio_except import UnloadSong, PlayNextSong
+from rigdio_except import UnloadSong, PlayNextSong, TokenError
 from rigdio_util import timeToSeconds
 
 binaryOperators = set(["<", ">", "<=", ">=", "==", "!="])
+# comparison functions for each binary operator, resolved once when a condition is built
+comparators = {
+   "<" : operator.lt,
+   ">" : operator.gt,
+   "<=" : operator.le,
+   ">=" : operator.ge,
+   "==" : operator.eq,
+   "!=" : operator.ne
+}
 unloadableOperators = set(["<", "<=", "=="])
 
 class Condition:
@@ -32,6 +42,16 @@ class Condition:
       """
       raise NotImplementedError("Condition subclass must override check().")
 
+   def isStatic (self):
+      """
+         Checks if this condition only depends on things that are fixed for a whole match (which team
+         is at home, the opponent and the match type), rather than on the score.
+
+         Static conditions are resolved once when the teams are loaded or the match type changes,
+         and are not checked again on goal presses. Override this to return True in such conditions.
+      """
+      return False
+
    def isInstruction (self):
       """
          Checks if something is a Condition or an Instruction. There is no need to override this.
@@ -72,40 +92,56 @@ class Condition:
       return {self.type() : tokens}
 
 class ArithCondition (Condition):
-   desc = """Superclass for all conditions that evaluate an arithmetic expression."""
+   desc = """Superclass for all conditions that compare a number from the game state."""
 
    def __init__(self, **kwargs):
       super().__init__(**kwargs)
 
    def check (self, gamestate):
-      args = self.args(gamestate)
-      return eval(self.expression().format(*args))
+      return self.compare(*self.args(gamestate))
 
    def args (self, gamestate):
       raise NotImplementedError("ArithCondition subclass must override args().")
 
-   def expression (self):
-      raise NotImplementedError("ArithCondition subclass must override expression().")
+   def compare (self, value):
+      """
+         Compares the value from args() against this condition. Subclasses set up everything needed
+         for this in their constructor, so no parsing happens when the condition is checked.
+      """
+      raise NotImplementedError("ArithCondition subclass must override compare().")
+
+def parseComparison (tokens, ctype):
+   """
+      Reads the operator and integer operand tokens of a comparison condition.
+
+      Returns (operator, comparison function, operand).
+   """
+   op = tokens[0]
+   if op == "=":
+      op = "=="
+   if op not in binaryOperators:
+      raise ValueError("invalid {} operator {}; valid operators are {}".format(ctype, op, ", ".join(sorted(binaryOperators))))
+   try:
+      value = int(tokens[1])
+   except (IndexError, ValueError):
+      raise ValueError("invalid {} value {}; must be integer.".format(ctype, " ".join(tokens[1:2])))
+   return op, comparators[op], value
 
 class GoalCondition (ArithCondition):
    desc = """Plays when the number of goals this player has scored meet the condition."""
 
    def __init__(self, tokens, **kwargs):
       super().__init__(**kwargs)
-      if tokens[0] == "=":
-         tokens[0] = "=="
-      if tokens[0] not in binaryOperators:
-         raise ValueError("invalid GoalCondition operator "+tokens[0]+"; valid operators are "+list(binaryOperators))
-      self.comparison = "{} "+str(tokens[0])+" "+str(tokens[1])
+      self.operator, self.comparator, self.value = parseComparison(tokens, type(self).__name__)
 
    def type (self):
       return "goals"
 
    def tokens (self):
-      return self.comparison.split(" ")[1:]
+      return [self.operator, str(self.value)]
 
-   def expression (self):
-      return self.comparison
+   def compare (self, value):
+      return self.comparator(value, self.value)
 
    def args (self, gamestate):
       return (gamestate.player_goals(self.pname,self.home),)
@@ -115,8 +151,12 @@ class EveryCondition (ArithCondition):
 
    def __init__(self, tokens, **kwargs):
       super().__init__(**kwargs)
-      self.comparison = "{} % "+tokens[0]+" == 0"
-      self.num = tokens[0]
+      try:
+         self.num = int(tokens[0])
+      except ValueError:
+         raise ValueError("Invalid EveryCondition token {}; must be integer.".format(tokens[0]))
+      if self.num == 0:
+         raise ValueError("EveryCondition number must not be 0.")
 
    def type (self):
       return "every"
@@ -127,8 +167,8 @@ class EveryCondition (ArithCondition):
    def args (self, gamestate):
       return (gamestate.player_goals(self.pname,self.home),)
 
-   def expression(self):
-      return self.comparison
+   def compare (self, value):
+      return value % self.num == 0
 
 class OpponentCondition (Condition):
    desc = """Plays when the opponent is one of the listed teams (separated by spaces, exclude slashes from ends)."""
@@ -145,6 +185,9 @@ class OpponentCondition (Condition):
    def check(self,gamestate):
       return gamestate.opponent_name(self.home) in self.others
 
+   def isStatic (self):
+      return True
+
    def type (self):
       return "opponent"
 
@@ -168,10 +211,7 @@ class LeadCondition (GoalCondition):
 
    def __init__ (self, **kwargs):
       # pass tokens up to GoalCondition, the only difference in handling is in args()
-      try:
-         super().__init__(**kwargs)
-      except ValueError:
-         raise ValueError("invalid LeadCondition operator "+tokens[0]+"; valid operators are "+list(binaryOperators))
+      super().__init__(**kwargs)
 
    def args (self, gamestate):
       gd = gamestate.team_score(self.home) - gamestate.opponent_score(self.home)
@@ -226,6 +266,9 @@ class MatchCondition (Condition):
    def check (self, gamestate):
       return gamestate.gametype.lower() in self.lst
 
+   def isStatic (self):
+      return True
+
    def type (self):
       return "match"
 
@@ -241,6 +284,9 @@ class HomeCondition (Condition):
    def check (self, gamestate):
       return self.home
 
+   def isStatic (self):
+      return True
+
    def type (self):
       return "home"
 
@@ -353,15 +399,7 @@ class TimeCondition (PromptCondition):
 
    def __init__ (self, tokens, **kwargs):
       super().__init__(dtype=TimeCondition.Prompt,**kwargs)
-      if tokens[0] == "=":
-         tokens[0] = "=="
-      if tokens[0] not in binaryOperators:
-         raise ValueError("invalid GoalCondition operator "+tokens[0]+"; valid operators are "+list(binaryOperators))
-      self.operator = tokens[0]
-      try:
-         self.time = int(tokens[1])
-      except:
-         raise ValueError("Invalid TimeCondition token {}; must be integer.".format(tokens[1]))
+      self.operator, self.comparator, self.time = parseComparison(tokens, "TimeCondition")
 
    def needsPrompt (self, gamestate):
       return gamestate.time == None
@@ -374,7 +412,7 @@ class TimeCondition (PromptCondition):
    def checkStored (self, gamestate):
       if gamestate.time > self.time and self.operator in unloadableOperators:
          raise UnloadSong
-      return eval("{} {} {}".format(gamestate.time, self.operator, self.time))
+      return self.comparator(gamestate.time, self.time)
 
    def type (self):
       return "time"
@@ -401,6 +439,9 @@ class MetaCondition (Condition):
    def subconditions (self):
       return self.sub
 
+   def isStatic (self):
+      return all(x.isStatic() for x in self.subconditions())
+
    def toYML (self):
       output = {self.type():[]}
       for item in self.subconditions():
@@ -813,28 +854,74 @@ instructions = {
    "louder" : LouderInstruction
 }
 
-def processTokens (tokenStr):
-   data = tokenStr.split()
+class Token:
+   """A token of a condition or instruction, with the index of its first character in the text."""
+   def __init__ (self, text, start):
+      self.text = text
+      self.start = start
+
+   def __str__ (self):
+      return self.text
+
+   def __repr__ (self):
+      return "Token({!r}, {})".format(self.text, self.start)
+
+def tokenize (text):
+   """
+      Splits a condition or instruction into tokens in a single pass.
+
+      Tokens are separated by whitespace. A token starting with [ runs until a word ending in ] (or
+      the end of the text, which is an error), with the whitespace inside collapsed to single spaces;
+      a ] inside can be escaped as \\]. A leading \\ on a token is dropped, e.g. \\[ for a token
+      starting with a literal [.
+   """
+   tokens = []
    i = 0
-   while i < len(data):
-      # escape character
-      if data[i][0] == "\\":
-         data[i] = data[i][1:]
+   n = len(text)
+   while i < n:
+      if text[i].isspace():
+         i += 1
+         continue
+      start = i
       # quoted string semantics
-      elif data[i][0] == "[":
-         data[i] = list(data[i])
-         while data[i+1][-1] != "]" or data[i+1][-2] == "\\":
-            temp = list(data.pop(i+1))
-            # remove escapes on end of string
-            if temp[-1] == "]" and temp[-2] == "\\":
-               temp.pop(-2)
-            data[i].append(" ")
-            data[i].extend(temp)
-         data[i].append(" ")
-         data[i].extend(list(data.pop(i+1)))
-         data[i] = "".join(data[i][1:-1]) # remove the []
-      i += 1
-   return data
+      if text[i] == "[":
+         words = []
+         word = []
+         i += 1
+         while True:
+            if i == n:
+               raise TokenError(start, "unterminated [")
+            c = text[i]
+            end = i+1 == n or text[i+1].isspace()
+            if c == "\\" and i+1 < n and text[i+1] == "]":
+               # escaped ]
+               word.append("]")
+               i += 2
+            elif c == "]" and end:
+               i += 1
+               break
+            elif c.isspace():
+               if word:
+                  words.append("".join(word))
+                  word = []
+               i += 1
+            else:
+               word.append(c)
+               i += 1
+         if word:
+            words.append("".join(word))
+         tokens.append(Token(" ".join(words), start))
+      else:
+         while i < n and not text[i].isspace():
+            i += 1
+         # escape character
+         word = text[start+1:i] if text[start] == "\\" else text[start:i]
+         tokens.append(Token(word, start))
+   return tokens
+
+def processTokens (tokenStr):
+   """Returns the text of each token in a condition or instruction, see tokenize()."""
+   return [token.text for token in tokenize(tokenStr)]
 
 def buildCondition(tokens, **kwargs):
    if len(tokens) == 0:
@@ -10,10 +10,18 @@ defaults = dict(
       alphabetical_sort_chants=0, # sort team chants alphabetically
       chant_timer_enabled_default=1, # enable chant timer by default
       chant_random_decay_weight=0.3, # base for exponential decay weighting when picking random chants (lower = less repeat)
+      anthem_overlap=0.0, # seconds the home anthem starts before the away anthem finishes fading out; 0 waits for the fade to end
+      anthem_crossfade=0, # fade the home anthem in over the overlap, crossfading it with the away anthem
       dark_mode_enabled=0, # enable dark mode
+      mpv_pool_size=8, # number of idle mpv players kept open; songs only open a player when they are played
+      chaoshorn_mixer=0, # play chaoshorn as one mix on a single mpv player instead of every song on its own player
+      loudness_cache=1, # remember loudness analysis results between sessions in loudness.cache, so songs are only analysed once
+      team_bundles=1, # save a compiled .4ccmc file next to each loaded .4ccm, so loading the team again skips parsing and analysis
+      tournament_library="", # folder of .4ccm exports to prepare in the background at startup and pick teams from; leave empty to disable
       show_goalhorn_volume_default=1, # show goalhorn volume sliders by default
       normalize_volume=1, # normalize all music to a consistent loudness level (uses target from level config); replaces individual volume sliders with a single master volume slider
       write_song_title_log=0, # write a title.log file that contains the current song's title/filename before clearing it, values above 0 sets the timer
+      victory_timer_refresh=250, # milliseconds between updates of the victory anthem timer
       write_to_log=1 # allow rigdio/rigdj to write log files (some systems don't allow rigdio/rigdj to write to log, causing it to crash)
    ),
    fade=dict(
@@ -48,7 +56,15 @@ defaults = dict(
    ),
    gameMinute=6.67,
    level=dict(
-      target = -14.0
+      target = -14.0,
+      backend = "auto", # loudness analysis backend: auto, mpv, pcm or ffmpeg (see loudness.py)
+      measure = "mean", # what target is compared to: mean (mean volume, dB) or lufs (integrated loudness, with the limiter driven by true peak)
+      workers = "auto", # songs analysed at once in the background; auto uses the idle CPU cores
+      processes = "auto", # most decoders (ffmpeg or mpv) running at once for background analysis; auto is one per CPU core. Songs analyzed as they're played don't wait for these
+      niceness = 10, # 0-19, how far to lower the priority of background analysis so it doesn't compete with streaming; only fully applies on Linux: on Windows it only covers ffmpeg processes, so the default mpv backend analyses at normal priority
+      estimate = 0, # songs longer than this many seconds are first estimated from a few windows, then measured in full in the background; 0 to always measure in full
+      windows = 8, # number of windows decoded when estimating a song's loudness
+      batch = 8 # with the pcm or ffmpeg backend, when more songs than this are waiting, measure this many with each ffmpeg process; 0 for one process per song. No effect with auto or mpv, which measure in-process without starting ffmpeg
    ),
    match="Group"
 )
@@ -59,8 +75,8 @@ def genConfig():
       file = open("config.yml",'x')
    except:
       return False
-   # fill yml file with default configs
-   yaml.dump(defaults["config"], file, default_flow_style=False)
+   # fill yml file with default configs, plus the optional level section
+   yaml.dump(dict(defaults["config"], level=defaults["level"]), file, default_flow_style=False)
    return True
 
 # create prompt window asking if user wishes to view config file
@@ -122,7 +138,10 @@ class ConfigValues:
          return
 
       try:
+         # the level section is optional, and overrides the default level settings
+         level = self.configs.pop("level", None)
          self.checkConfig()
+         self.checkLevel(level)
          defaults["config"] = self.configs
          self.configs = defaults
       except Exception as e:
@@ -140,9 +159,16 @@ class ConfigValues:
          'dark_mode_enabled:int',
          'show_goalhorn_volume_default:int',
          'normalize_volume:int',
+         'loudness_cache:int',
+         'team_bundles:int',
+         'mpv_pool_size:int',
+         'chaoshorn_mixer:int',
          'write_to_log:int',
          'write_song_title_log:int',
-         'chant_random_decay_weight:float'
+         'victory_timer_refresh:int',
+         'chant_random_decay_weight:float',
+         'anthem_overlap:float',
+         'anthem_crossfade:int'
       ]
       for item in mustBeValid:
          items = item.split(':')
@@ -160,6 +186,36 @@ class ConfigValues:
             print("config.yml error: {} must be {}; using default value {}.".format(items[0], items[1], default))
             self.configs[items[0]] = default
 
+   def checkLevel(self, level):
+      if level is None:
+         return
+      if not isinstance(level, dict):
+         print("config.yml error: level must be a dict; using default values.")
+         return
+      # settings that only take one of a few names; backend names the backends in loudness.py
+      choices = dict(backend=("auto", "mpv", "pcm", "ffmpeg"), measure=("mean", "lufs"))
+      for key, value in level.items():
+         if key not in defaults["level"]:
+            print("config.yml error: unknown level setting {}; ignoring it.".format(key))
+            continue
+         default = defaults["level"][key]
+         if key in choices:
+            valid = value in choices[key]
+         elif isinstance(default, float):
+            valid = isinstance(value, (int, float))
+         elif default == "auto":
+            # either auto or a positive number
+            valid = value == "auto" or (isinstance(value, int) and value > 0)
+         elif key == "windows":
+            valid = isinstance(value, int) and value > 0
+         else:
+            valid = isinstance(value, type(default))
+         if not valid:
+            expected = "one of " + ", ".join(choices[key]) if key in choices else type(default).__name__
+            print("config.yml error: level:{} must be {}; using default value {}.".format(key, expected, default))
+            continue
+         defaults["level"][key] = value
+
    def __getattr__(self, key):
       return self.configs[key]
 
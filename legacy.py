@@ -4,13 +4,16 @@ import os
 import sys
 os.environ["PATH"] = dirname(abspath(sys.argv[0])) + os.pathsep + os.environ["PATH"]
 import mpv
+import asyncio
+import math
 import random
 import time
-import subprocess
-import re
 import threading
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from config import settings
+from rigdio_except import SongNotFound
+from loudness import analyze_loudness, start_background_analysis, PRIORITY_ANTHEM
 
 # Cache of playback positions (in ms) keyed by absolute file path.
 # Used by sync-enabled goalhorns to preserve playback position
@@ -18,93 +21,220 @@ from config import settings
 # without sharing a single MediaPlayer object (which caused concurrency bugs).
 _position_cache = {}
 
-# Cache of loudness analysis results keyed by absolute file path.
-# Populated lazily by analyze_loudness when a song is played,
-# or proactively by start_background_analysis after loading.
-_loudness_cache = {}
-
-# Track files currently being analyzed to avoid duplicate work.
-_loudness_pending = set()
-_loudness_pending_lock = threading.Lock()
-
-def analyze_loudness(filepath, target_db):
-   """Analyze audio loudness using ffmpeg volumedetect and calculate gain needed
-   to reach target_db. Returns (gain_db, needs_limiter) or (None, False) on failure.
-   A limiter is needed when the full gain would cause peak clipping.
-   Thread-safe: uses a lock to prevent duplicate ffmpeg calls for the same file."""
-   fullpath = abspath(filepath)
-   # fast path: already cached
-   if fullpath in _loudness_cache:
-      return _loudness_cache[fullpath]
-   # claim this file or wait for another thread to finish it
-   with _loudness_pending_lock:
-      if fullpath in _loudness_cache:
-         return _loudness_cache[fullpath]
-      if fullpath in _loudness_pending:
-         pending = True
-      else:
-         _loudness_pending.add(fullpath)
-         pending = False
-   if pending:
-      # another thread is analyzing this file; wait for it
-      while fullpath not in _loudness_cache:
-         time.sleep(0.01)
-      return _loudness_cache[fullpath]
-   try:
-      kwargs = dict(capture_output=True, text=True, errors="replace", timeout=30)
-      if os.name == "nt":
-         kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW
-      result = subprocess.run(
-         ["ffmpeg", "-vn", "-i", fullpath, "-af", "volumedetect", "-f", "null", "-"],
-         **kwargs
-      )
-      stderr = result.stderr
-      mean_match = re.search(r"mean_volume:\s*(-?[\d.]+)\s*dB", stderr)
-      max_match = re.search(r"max_volume:\s*(-?[\d.]+)\s*dB", stderr)
-      if not mean_match or not max_match:
-         print("   Could not parse volumedetect output for {}".format(fullpath))
-         result = (None, False)
-         _loudness_cache[fullpath] = result
-         return result
-      mean_db = float(mean_match.group(1))
-      max_db = float(max_match.group(1))
-      gain = target_db - mean_db
-      needs_limiter = (max_db + gain) > 0.0
-      if needs_limiter:
-         print("   {} has mean volume of {:.1f} dB and peak of {:.1f} dB, target is {:.1f} dB; applying {:.1f} dB gain with limiter.".format(
-            basename(fullpath), mean_db, max_db, target_db, gain))
-      else:
-         print("   {} has mean volume of {:.1f} dB and peak of {:.1f} dB, target is {:.1f} dB; applying {:.1f} dB gain.".format(
-            basename(fullpath), mean_db, max_db, target_db, gain))
-      result = (gain, needs_limiter)
-      _loudness_cache[fullpath] = result
-      return result
-   except FileNotFoundError:
-      print("   ffmpeg not found, skipping normalization for {}".format(fullpath))
-      _loudness_cache[fullpath] = (None, False)
-      return None, False
-   except Exception as e:
-      print("   Error analyzing loudness for {}: {}".format(fullpath, e))
-      _loudness_cache[fullpath] = (None, False)
-      return None, False
-   finally:
-      with _loudness_pending_lock:
-         _loudness_pending.discard(fullpath)
-
-def start_background_analysis(filepaths, target_db):
-   """Start analyzing loudness for all files in a background thread pool.
-   Non-blocking: returns immediately. Results populate _loudness_cache.
-   If a file is played before its analysis completes, play() will wait for it."""
-   unique = set(abspath(f) for f in filepaths if isfile(abspath(f)))
-   to_analyze = [f for f in unique if f not in _loudness_cache and f not in _loudness_pending]
-   if not to_analyze:
-      return
-   print("Starting background loudness analysis for {} file(s)...".format(len(to_analyze)))
-   def worker():
-      with ThreadPoolExecutor(max_workers=min(4, len(to_analyze))) as executor:
-         list(executor.map(lambda f: analyze_loudness(f, target_db), to_analyze))
-   thread = threading.Thread(target=worker, daemon=True)
-   thread.start()
+class MpvPool:
+   """
+      Bounded pool of mpv cores shared by every ConditionPlayer.
+
+      A ConditionPlayer only holds a core once it is actually played, so loading a team only opens
+      a few idle cores ahead of time (see warm()). When the pool is full, the least recently used core that isn't playing is taken
+      from its owner, which remembers where it was and reloads the file on its next play. Playing
+      cores are never taken, so the pool may grow past its size (e.g. during chaoshorn); any extra
+      cores are closed as soon as they're released.
+   """
+   def __init__ (self, size):
+      self.size = max(1, size)
+      self.lock = threading.RLock()
+      # ConditionPlayer : core, least recently used first
+      self.attached = OrderedDict()
+      # cores with no owner, ready to be reused
+      self.free = []
+      # cores being opened by warm()
+      self.warming = 0
+
+   def count (self):
+      return len(self.attached) + len(self.free)
+
+   def room (self):
+      """Returns how many more songs can get a core without taking one from another song."""
+      with self.lock:
+         return self.size - len(self.attached)
+
+   def acquire (self, owner):
+      """Returns the core attached to owner, taking one from the pool if it has none."""
+      with self.lock:
+         if owner in self.attached:
+            self.attached.move_to_end(owner)
+            return self.attached[owner]
+         core = self._take()
+         self.attached[owner] = core
+         return core
+
+   def release (self, owner):
+      """Detaches owner's core (if any) and returns it to the pool."""
+      with self.lock:
+         core = self.attached.pop(owner, None)
+         if core is None:
+            return
+         if self.count() >= self.size:
+            core.terminate()
+         else:
+            self._clean(core)
+            self.free.append(core)
+
+   def warm (self):
+      """
+         Opens an idle core ahead of time if the pool has room, so that the first song played doesn't
+         wait for mpv to start. mpv is started outside the lock, so this can run on loader threads.
+      """
+      with self.lock:
+         if self.count() + self.warming >= self.size:
+            return False
+         self.warming += 1
+      try:
+         core = self._create()
+      finally:
+         with self.lock:
+            self.warming -= 1
+      with self.lock:
+         if self.count() >= self.size:
+            core.terminate()
+            return False
+         self.free.append(core)
+      return True
+
+   def close (self):
+      with self.lock:
+         for core in list(self.attached.values()) + self.free:
+            core.terminate()
+         self.attached.clear()
+         self.free.clear()
+
+   def _take (self):
+      if self.free:
+         return self.free.pop()
+      if self.count() >= self.size:
+         # evict the least recently used owner that isn't playing
+         for owner in self.attached:
+            if owner.evictable():
+               core = self.attached.pop(owner)
+               owner.evicted()
+               self._clean(core)
+               return core
+         print("All {} mpv cores are in use, opening another.".format(self.size))
+      return self._create()
+
+   def _create (self):
+      # vid=False prevents video tracks; pause=True keeps file paused until play()
+      # keep_open=True prevents idle mode after EOF (matches ended state behavior)
+      return mpv.MPV(vid=False, pause=True, keep_open=True, volume_max=220)
+
+   def _clean (self, core):
+      # reset everything a ConditionPlayer may have changed so the core can be reused
+      core.command("stop")
+      core.pause = True
+      core.loop_file = "no"
+      core.af = ""
+      core.speed = 1.0
+      core.volume = 100
+
+_mpv_pool = MpvPool(settings.config["mpv_pool_size"])
+
+class ScheduledCall:
+   """Handle for a callback queued on the PlaybackDispatcher."""
+   def __init__ (self, when, callback):
+      self.when = when
+      self.callback = callback
+      self.cancelled = False
+
+   def cancel (self):
+      # checked by the dispatcher before running the callback, so it's safe from any thread
+      self.cancelled = True
+
+class PlaybackDispatcher:
+   """
+      Owns playback timing: end of song instructions, manual loops, fades, chant timeouts and the
+      title log all run on one asyncio event loop, in a single thread started on first use.
+
+      mpv reports the end of a file through property observers running on its own event threads;
+      those handlers only post work here, so instructions that go on to play other songs never run
+      inside an mpv callback, and no thread has to poll eof_reached. Timed work is a loop timer or
+      a task rather than a thread of its own, so the number of threads doesn't grow with the number
+      of songs playing, and close() stops all of it at once.
+   """
+   # seconds close() waits for the loop to finish cancelling its tasks
+   closeTimeout = 2
+
+   def __init__ (self):
+      self.loop = None
+      self.thread = None
+      self.closed = False
+      self.lock = threading.Lock()
+
+   def _start (self):
+      # returns the event loop, starting its thread if it isn't running yet, or None once closed
+      with self.lock:
+         if self.closed:
+            return None
+         if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+         return self.loop
+
+   def post (self, callback):
+      """Runs callback on the dispatcher thread as soon as possible."""
+      return self.schedule(0, callback)
+
+   def schedule (self, delay, callback):
+      """Runs callback on the dispatcher thread after delay seconds. Returns a cancellable ScheduledCall."""
+      call = ScheduledCall(time.monotonic() + delay, callback)
+      loop = self._start()
+      if loop is None:
+         call.cancel()
+         return call
+      def arm ():
+         # calls posted without a delay run in the order they were posted
+         if delay > 0:
+            loop.call_later(max(0, call.when - time.monotonic()), self._call, call)
+         else:
+            self._call(call)
+      loop.call_soon_threadsafe(arm)
+      return call
+
+   def run (self, coroutine):
+      """
+         Runs a coroutine as a task on the dispatcher's loop. Returns a concurrent.futures.Future;
+         cancelling it cancels the task.
+      """
+      loop = self._start()
+      if loop is None:
+         coroutine.close()
+         return None
+      return asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+   def close (self):
+      """Stops the loop, cancelling every pending call and task, and waits for its thread to end."""
+      with self.lock:
+         self.closed = True
+         loop, thread = self.loop, self.thread
+      if loop is None:
+         return
+      loop.call_soon_threadsafe(loop.stop)
+      thread.join(PlaybackDispatcher.closeTimeout)
+
+   def _call (self, call):
+      if call.cancelled:
+         return
+      try:
+         call.callback()
+      except Exception as e:
+         print("Error in playback callback {}: {}".format(call.callback, e))
+
+   def _run (self):
+      asyncio.set_event_loop(self.loop)
+      self.loop.run_forever()
+      # stopped by close(); give the remaining tasks a chance to clean up
+      tasks = asyncio.all_tasks(self.loop)
+      for task in tasks:
+         task.cancel()
+      self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+      self.loop.close()
+
+dispatcher = PlaybackDispatcher()
+
+# threads pre-rolling songs (see PlayerManager.prepare()); a few are enough, as they mostly wait for mpv
+PREPARE_WORKERS = 2
+_preparer = ThreadPoolExecutor(max_workers=PREPARE_WORKERS, thread_name_prefix="prepare")
 
 class ConditionList:
    def __init__(self, pname = "NOPLAYER", tname = "NOTEAM", data = [], songname = "New Song", home = True, runInstructions = True):
@@ -120,13 +250,16 @@ class ConditionList:
       self.endType = "loop"
       self.pauseType = "continue"
       for tokenStr in data:
-         tokens = processTokens(tokenStr)
+         # entries read by rigparse are already split into tokens
+         tokens = processTokens(tokenStr) if isinstance(tokenStr, str) else tokenStr
          condition = buildCondition(tokens, pname=self.pname, tname=self.tname, home=self.home)
          if condition.isInstruction():
             self.instructions.append(condition)
          else:
             self.conditions.append(condition)
       self.all = self.conditions + self.instructions
+      # conditions checked on goal presses; fold() removes the static ones
+      self.checked = self.conditions
       if runInstructions:
          self.instruct()
 
@@ -191,10 +324,21 @@ class ConditionList:
          self.conditions.remove(item)
       return item
 
+   def fold (self, gamestate):
+      """
+         Resolves the static conditions (home, opponent, match type) against the game state, so
+         that check() only needs to evaluate the remaining ones.
+
+         Returns False if a static condition is false, i.e. this song can't play until the teams or
+         the match type change.
+      """
+      self.checked = [c for c in self.conditions if not c.isStatic()]
+      return all(c.check(gamestate) for c in self.conditions if c.isStatic())
+
    def check (self, gamestate):
       if self.disabled:
          raise UnloadSong
-      for condition in self.conditions:
+      for condition in self.checked:
          print("Checking {}".format(condition))
          if not condition.check(gamestate):
             return False
@@ -216,13 +360,34 @@ class ConditionList:
       return output
 
 class ConditionPlayer (ConditionList):
+   # label of the fade filter in a song's af chain
+   fadeLabel = "rigdio_fade"
+   # seconds after a fade's end before its filter is removed, for the audio mpv has already buffered
+   fadeLatency = 0.25
+
    def __init__ (self, pname, tname, data, songname, home, type = "goalhorn", sync = False):
       ConditionList.__init__(self,pname,tname,data,songname,home,False)
       self.type = type
       self.isGoalhorn = type=="goalhorn"
       self.sync = sync
       self.song = self.loadsong(songname)
+      # position and speed to restore if the mpv core was taken back by the pool
+      self.resume = None
+      # callbacks run on the dispatcher thread when the song reaches the end of its file
+      self.endCallbacks = []
+      # mpv properties last written to the current core, so unchanged values aren't written again
+      self.applied = {}
+      # set by prepare() once the song is loaded, filtered and seeked, ready to be unpaused
+      self.prerolled = False
+      self.prerollPosition = None
+      # held while getting the song ready, since prepare() runs off the Tk thread
+      self.lock = threading.RLock()
+      # ScheduledCall pausing the song at the end of its fade out, while it's fading out
       self.fade = None
+      # callbacks to run once the fade out ends, see afterFade()
+      self.fadeCallbacks = []
+      # afade filter appended to the song's filters while it fades in or out
+      self.fadeFilter = None
       self.startTime = 0
       self.customSpeed = False
       self.firstPlay = True
@@ -249,7 +414,7 @@ class ConditionPlayer (ConditionList):
 
    def _configureLooping (self):
       # configure native looping for repeat-enabled songs;
-      # called both at init and after reloadSong since each player is separate
+      # called whenever a core is attached since cores are shared through the pool
       if self.repeat and self.event is None and isinstance(self.song, mpv.MPV) and not self.manualLoop:
          self.song.loop_file = "inf"
 
@@ -267,54 +432,227 @@ class ConditionPlayer (ConditionList):
       print("Attempting to load "+filename)
       fullpath = abspath(filename)
 
-      # if song cannot be found, return error message instead of MediaPlayer
+      # if song cannot be found, return error message instead of None
       # reason is to have rigdio check for all missing files before raising exception
       if not isfile(fullpath):
          return basename(fullpath) + " not found."
-      # vid=False prevents video tracks; pause=True keeps file paused until play()
-      # keep_open=True prevents idle mode after EOF (matches ended state behavior)
-      player = mpv.MPV(vid=False, pause=True, keep_open=True, volume_max=220)
-      player.loadfile(fullpath)
-      return player
+      # the file is opened lazily by attach() when the song is first played
+      return None
+
+   def attach (self):
+      """Makes sure this song has an mpv core with its file loaded, taking one from the pool if needed."""
+      if isinstance(self.song, mpv.MPV) or isinstance(self.song, str):
+         return
+      core = _mpv_pool.acquire(self)
+      options = {}
+      if self.resume is not None:
+         pos, speed = self.resume
+         options["start"] = "{:.3f}".format(pos)
+         core.speed = speed
+         self.resume = None
+      self.applied = {}
+      core.loadfile(abspath(self.songname), **options)
+      # wait for the file to open so that seeks made by play() and instructions take effect
+      try:
+         core.wait_for_property("time-pos", lambda pos: pos is not None, timeout=5)
+      except TimeoutError:
+         print("Timed out waiting for mpv to open {}.".format(self.songname))
+      self.song = core
+      self._configureLooping()
+      core.observe_property("eof-reached", self._eofObserver)
+
+   def detach (self):
+      """Returns this song's mpv core to the pool; the file is reloaded from the start on the next play."""
+      if isinstance(self.song, mpv.MPV):
+         core = self.song
+         core.unobserve_property("eof-reached", self._eofObserver)
+         self.song = None
+         _mpv_pool.release(self)
+      self.resume = None
+      self.prerolled = False
+
+   def evictable (self):
+      # called by the pool with its lock held; only songs that aren't playing or fading can lose their core,
+      # nor songs whose core is still opening the file (attach() only sets self.song once it's open), nor
+      # songs being readied by play() or prepare(), which hold self.lock. If the song can be evicted,
+      # self.lock stays held until evicted(), which the pool calls straight after
+      if not self.lock.acquire(blocking=False):
+         return False
+      if isinstance(self.song, mpv.MPV) and self.fade is None and (self.song.pause or self.song.eof_reached):
+         return True
+      self.lock.release()
+      return False
+
+   def evicted (self):
+      # called by the pool before it takes this song's core for another song, with self.lock held by evictable()
+      try:
+         if not self.firstPlay and not self.song.eof_reached and self.song.time_pos is not None:
+            self.resume = (self.song.time_pos, self.song.speed)
+         self.song.unobserve_property("eof-reached", self._eofObserver)
+         self.song = None
+         self.prerolled = False
+      finally:
+         self.lock.release()
+
+   def _eofObserver (self, name, value):
+      # runs on mpv's event thread; hand the work over to the dispatcher
+      if value:
+         dispatcher.post(self._ended)
+
+   def _ended (self):
+      for callback in list(self.endCallbacks):
+         callback(self)
+
+   def onEnd (self, callback):
+      """Registers callback(player) to run on the dispatcher thread whenever this song reaches its end."""
+      if callback not in self.endCallbacks:
+         self.endCallbacks.append(callback)
+
+   def removeEnd (self, callback):
+      if callback in self.endCallbacks:
+         self.endCallbacks.remove(callback)
 
    def reloadSong (self):
       self.firstPlay = True
       # clear saved position since we're resetting to the beginning
       _position_cache.pop(abspath(self.songname), None)
-      self.song = self.loadsong(self.songname)
-      self._configureLooping()
+      self.detach()
       self.instruct()
 
-   def play (self):
-      if self.fade is not None:
-         print("Song played quickly after pause, cancelling fade.")
-         thread = self.fade
-         self.fade = None
-         thread.join()
-      # apply normalization gain as audio filter before playback (lazy — only when actually played)
-      if settings.config["normalize_volume"] and isinstance(self.song, mpv.MPV):
-         fullpath = abspath(self.songname)
-         gain, needs_limiter = analyze_loudness(fullpath, settings.level["target"])
-         if gain is not None:
-            if self.louder:
-               total_gain = gain + self.boostValue
-               self.song.af = "volume={:.1f}dB,alimiter=limit=0.95".format(total_gain)
-            elif needs_limiter:
-               self.song.af = "volume={:.1f}dB,alimiter=limit=0.95".format(gain)
-            else:
-               self.song.af = "volume={:.1f}dB".format(gain)
-            self.normalize_gain = gain
-      self.song.pause = False
-      self.song.volume = self._toMpvVolume(self.maxVolume)
+   def rewind (self):
+      """In-place reset: seeks back to the start without reloading the file."""
+      self.firstPlay = True
+      _position_cache.pop(abspath(self.songname), None)
+      self.resume = None
+      self.prerolled = False
+      if isinstance(self.song, mpv.MPV):
+         self.song.time_pos = 0
+
+   def _set (self, name, value):
+      # write an mpv property only if it changed since this song last set it on its core
+      if self.applied.get(name) != value:
+         setattr(self.song, name, value)
+         self.applied[name] = value
+
+   def filterChain (self):
+      """Returns the audio filters applying this song's normalization gain (and volume boost), or "" for none."""
+      if not settings.config["normalize_volume"]:
+         return ""
+      try:
+         gain, needs_limiter = analyze_loudness(abspath(self.songname), settings.level["target"], self.startTime / 1000.0)
+      except Exception as e:
+         # play it without normalization rather than not at all
+         print("Could not get loudness of {}, playing it unnormalized: {}".format(self.songname, e))
+         return ""
+      if gain is None:
+         return ""
+      self.normalize_gain = gain
+      if self.louder:
+         return "volume={:.1f}dB,alimiter=limit=0.95".format(gain + self.boostValue)
+      elif needs_limiter:
+         return "volume={:.1f}dB,alimiter=limit=0.95".format(gain)
+      return "volume={:.1f}dB".format(gain)
+
+   def audioFilters (self):
+      """Returns the song's whole af chain: its normalization (see filterChain()), then its fade if it's fading."""
+      chain = self.filterChain()
+      if self.fadeFilter is None:
+         return chain
+      fade = "@{}:{}".format(ConditionPlayer.fadeLabel, self.fadeFilter)
+      return chain + "," + fade if chain else fade
+
+   def applyFilters (self):
+      """Updates the audio filters of a loaded song, e.g. after the volume boost changed."""
+      if isinstance(self.song, mpv.MPV):
+         self._set("af", self.audioFilters())
+
+   def _fade (self, direction, duration, position):
+      # returns an afade filter fading in or out over duration seconds from position in the file;
+      # afade counts in file time, which runs faster or slower than real time with the speed
+      speed = self.song.speed or 1.0
+      return "afade=t={}:st={:.3f}:d={:.3f}".format(direction, max(0.0, position), duration * speed)
+
+   def startPosition (self):
+      """Returns where the next play() should seek to in seconds, or None to carry on from where the song is."""
+      # start instructions take priority over the synced position on the first play
+      if self.firstPlay and any(isinstance(instruction, StartInstruction) for instruction in self.instructionsStart):
+         return self.startTime / 1000.0
       # restore saved playback position for sync-enabled goalhorns
-      if self.sync and self.isGoalhorn and not self.warcry and isinstance(self.song, mpv.MPV):
+      if self.sync and self.isGoalhorn and not self.warcry:
          fullpath = abspath(self.songname)
          if fullpath in _position_cache:
-            self.song.time_pos = _position_cache[fullpath] / 1000.0
-      if self.firstPlay:
-         for instruction in self.instructionsStart:
-            instruction.run(self)
-         self.firstPlay = False
+            return _position_cache[fullpath] / 1000.0
+      return None
+
+   def _ready (self):
+      # load the file, apply filters and volume and seek to the start, without unpausing
+      self.attach()
+      if not isinstance(self.song, mpv.MPV):
+         return
+      self.applyFilters()
+      self._set("volume", self._toMpvVolume(self.maxVolume))
+      position = self.startPosition()
+      # a pre-rolled song only seeks again if its start changed since (e.g. another synced song paused)
+      if position is not None and not (self.prerolled and self.prerollPosition == position):
+         self.song.time_pos = position
+      self.prerollPosition = position
+
+   def prepare (self):
+      """
+         Gets this song ready to play ahead of time, so that play() only has to unpause it: opens its
+         file, computes its gain, applies its filters and volume and seeks to where it will start.
+
+         Meant to be run off the Tk thread, since loudness analysis and opening the file may block.
+         Does nothing if the song is disabled, playing, fading out or missing.
+      """
+      with self.lock:
+         if self.disabled or self.fade is not None or isinstance(self.song, str):
+            return
+         if isinstance(self.song, mpv.MPV) and not self.song.pause:
+            return
+         self._ready()
+         self.prerolled = isinstance(self.song, mpv.MPV)
+
+   def play (self, pressed = None, fadeIn = None):
+      """
+         Plays the song; pressed is the perf_counter() time of the button press, for logging latency.
+         If fadeIn is given, the song fades in over that many seconds, e.g. to crossfade with a song
+         fading out.
+      """
+      if pressed is None:
+         pressed = time.perf_counter()
+      with self.lock:
+         if self.fade is not None:
+            print("Song played quickly after pause, cancelling fade.")
+            self.fade.cancel()
+            self.fade = None
+            self.fadeCallbacks = []
+         self.fadeFilter = None
+         self._ready()
+         if fadeIn and isinstance(self.song, mpv.MPV):
+            self.fadeIn(fadeIn)
+         if self.firstPlay:
+            for instruction in self.instructionsStart:
+               # the start position was already seeked to
+               if not isinstance(instruction, StartInstruction):
+                  instruction.run(self)
+            self.firstPlay = False
+         self.prerolled = False
+         self._logLatency(pressed)
+         self.song.pause = False
+
+   def _logLatency (self, pressed):
+      # mpv reports core-idle as False once audio is actually playing
+      if not self.song.pause:
+         return
+      core = self.song
+      started = []
+      def observer (name, value):
+         if value is False and not started:
+            started.append(True)
+            print("{} started playing {:.0f} ms after it was pressed.".format(basename(self.songname), 1000*(time.perf_counter() - pressed)))
+            dispatcher.post(lambda: core.unobserve_property("core-idle", observer))
+      core.observe_property("core-idle", observer)
 
    def _toMpvVolume (self, sliderValue):
       # Convert slider value (0-200, 100=unity) to mpv's cubic volume scale.
@@ -331,9 +669,15 @@ class ConditionPlayer (ConditionList):
 
    def adjustVolume (self, value):
       self.maxVolume = int(value)
-      self.song.volume = self._toMpvVolume(self.maxVolume)
+      if isinstance(self.song, mpv.MPV):
+         self._set("volume", self._toMpvVolume(self.maxVolume))
 
-   def pause (self, fade=None):
+   def pause (self, fade=None, callback=None):
+      # nothing to pause if the file was already unloaded (e.g. by an end instruction)
+      if not isinstance(self.song, mpv.MPV):
+         if callback is not None:
+            callback()
+         return
       # save playback position for sync-enabled goalhorns before pausing
       if self.sync and self.isGoalhorn and not self.warcry and isinstance(self.song, mpv.MPV):
          pos = self.song.time_pos
@@ -344,50 +688,98 @@ class ConditionPlayer (ConditionList):
       # don't fade out if the song has already ended (e.g. advance/warcry)
       if fade and not self.song.eof_reached:
          print("Fading out {}.".format(self.songname))
-         self.fade = threading.Thread(target=self.fadeOut)
-         self.fade.start()
+         self.fadeOut(callback)
       else:
          for instruction in self.instructionsPause:
             instruction.run(self)
          self.song.pause = True
          if self.song.eof_reached:
             self.reloadSong()
+         if callback is not None:
+            callback()
 
-   def onEnd (self, callback):
-      @self.song.event_callback('end-file')
-      def _handler(event):
-         callback()
+   def fadeIn (self, duration):
+      """Fades the song in over duration seconds from where it's about to play."""
+      with self.lock:
+         position = self.prerollPosition if self.prerollPosition is not None else (self.song.time_pos or 0)
+         fade = self._fade("in", duration, position)
+         self.fadeFilter = fade
+         self.applyFilters()
+      def done ():
+         # a finished fade in would silence the song if it went back before the fade (e.g. looping)
+         with self.lock:
+            if self.fadeFilter is fade:
+               self.fadeFilter = None
+               self.applyFilters()
+      dispatcher.schedule(duration + ConditionPlayer.fadeLatency, done)
 
-   def fadeOut (self):
-      # save playback position for sync-enabled goalhorns before fading out
-      if self.sync and self.isGoalhorn and not self.warcry and isinstance(self.song, mpv.MPV):
-         pos = self.song.time_pos
-         if pos is not None:
-            _position_cache[abspath(self.songname)] = int(pos * 1000)
-      i = 100
-      mpvVol = self._toMpvVolume(self.maxVolume)
-      while i > 0:
-         if self.fade == None:
-            break
-         volume = int(mpvVol * i/100)
-         self.song.volume = volume
-         sleep(settings.fade["time"]/100)
-         i -= 1
-      for instruction in self.instructionsPause:
-         instruction.run(self)
-      self.song.pause = True
-      if self.song.eof_reached:
-         self.reloadSong()
-      self.song.volume = self._toMpvVolume(self.maxVolume)
-      self.fade = None
+   def fadeOut (self, callback=None):
+      """
+         Fades the song out over fade:time seconds, then pauses it and runs callback.
+
+         The whole fade is one afade filter ramping the gain sample by sample, written to mpv in a
+         single af change; the pause is scheduled on the dispatcher for when it's done, so nothing
+         waits on it. Playing the song again before then cancels the fade.
+      """
+      duration = settings.fade["time"]
+      with self.lock:
+         self.fadeFilter = self._fade("out", duration, self.song.time_pos or 0)
+         self.applyFilters()
+         fade = None
+         def done ():
+            self._fadeDone(fade)
+         fade = dispatcher.schedule(duration + ConditionPlayer.fadeLatency, done)
+         self.fade = fade
+         self.fadeCallbacks = [] if callback is None else [callback]
+
+   def afterFade (self, callback):
+      """
+         Runs callback once the song has faded out and paused, like fadeOut()'s callback (so not at
+         all if it's played again first). Returns False, without running it, if it isn't fading out.
+      """
+      with self.lock:
+         if self.fade is None:
+            return False
+         self.fadeCallbacks.append(callback)
+         return True
+
+   def fadeRemaining (self):
+      """Returns the seconds left until the song has faded out, or None if it isn't fading out."""
+      fade = self.fade
+      if fade is None:
+         return None
+      return max(0.0, fade.when - ConditionPlayer.fadeLatency - time.monotonic())
+
+   def _fadeDone (self, fade):
+      # runs on the dispatcher thread once the song has faded out
+      with self.lock:
+         # played again in the meantime
+         if self.fade is not fade:
+            return
+         self.fade = None
+         callbacks = self.fadeCallbacks
+         self.fadeCallbacks = []
+         for instruction in self.instructionsPause:
+            instruction.run(self)
+         self.song.pause = True
+         self.fadeFilter = None
+         self.applyFilters()
+         if self.song.eof_reached:
+            self.reloadSong()
+      for callback in callbacks:
+         callback()
 
    def disable (self):
-      self.song.command("stop")
+      self.detach()
       super().disable()
 
 class PlayerManager:
+   # title log task of the last song played by any PlayerManager, see writeTitleLog()
+   titleLog = None
+
    def __init__ (self, clists, home, game, master):
-      # song information
+      # song information; clists only holds the songs that can play in this match, see fold()
+      self.allClists = list(clists)
       self.clists = clists
       self.home = home
       self.game = game
@@ -396,10 +788,54 @@ class PlayerManager:
       # derived information
       self.song = None
       self.lastSong = None
-      self.endChecker = None
       self.pname = clists[0].pname
       self.futureVolume = None
       self.warcry = True
+      self.buildIndex()
+
+   def buildIndex (self):
+      """
+         Precomputes everything getSong needs that only depends on the song list, not the game state.
+
+         Must be called again whenever self.clists changes.
+      """
+      # songs tried in warcry mode (all songs) and after a warcry (non-warcry songs only), in priority order
+      self.warcryOrder = list(self.clists)
+      self.regularOrder = [c for c in self.clists if not c.warcry]
+      # warcry songs, and whether they should be picked at random
+      self.warcrySongs = [c for c in self.clists if c.warcry]
+      self.warcryRandom = len(self.warcrySongs) > 0 and all(c.randomise for c in self.warcrySongs)
+      # pname : non-warcry songs to pick from at random, only for players whose songs are all randomised
+      pools = {}
+      for clist in self.regularOrder:
+         pools.setdefault(clist.pname, []).append(clist)
+      self.randomPools = {pname: pool for pname, pool in pools.items() if all(c.randomise for c in pool)}
+      # songs with nothing left to check always pass unless they've been disabled
+      self.unconditional = set(id(c) for c in self.clists if len(c.checked) == 0)
+
+   def unload (self, clist):
+      """Removes a song that will never play again, closing its file."""
+      clist.disable()
+      self.clists.remove(clist)
+      self.allClists.remove(clist)
+      self.buildIndex()
+
+   def fold (self, gamestate):
+      """
+         Resolves static conditions for every song against the current teams and match type.
+
+         Songs that can't play in this match are left out of selection and give their mpv core
+         back to the pool; they come back if fold() is called again after the match changes.
+      """
+      self.clists = []
+      for clist in self.allClists:
+         if clist.fold(gamestate):
+            self.clists.append(clist)
+         # don't close the file of a song that's playing or fading out
+         elif clist is not self.song and clist.fade is None:
+            clist.detach()
+      self.buildIndex()
+      return len(self.allClists) - len(self.clists)
 
    def __iter__ (self):
       for x in self.clists:
@@ -410,90 +846,102 @@ class PlayerManager:
          self.song.adjustVolume(value)
       self.futureVolume = value
 
+   def nextSong (self):
+      """Returns the song getSong() will pick next if that can be known without checking the game state, else None."""
+      if self.warcry and self.warcryRandom:
+         return None
+      order = self.warcryOrder if self.warcry else self.regularOrder
+      for clist in order:
+         if clist.disabled:
+            continue
+         # randomised and conditional songs depend on the roll or the game state
+         if (clist.randomise and not clist.warcry and clist.pname in self.randomPools) or id(clist) not in self.unconditional:
+            return None
+         return clist
+      return None
+
+   def prepare (self):
+      """
+         Pre-rolls the song this button will play next (see nextSong()) on the _preparer threads. A
+         song that doesn't hold an mpv core yet is only pre-rolled if the pool has room for it, so
+         pre-rolling never takes a core from another song. Returns whether it took up room in the pool.
+      """
+      clist = self.nextSong()
+      if clist is None or clist is self.song or clist.prerolled:
+         return False
+      needsCore = not isinstance(clist.song, mpv.MPV)
+      if needsCore and _mpv_pool.room() <= 0:
+         return False
+      _preparer.submit(self._prepare, clist)
+      return needsCore
+
+   def _prepare (self, clist):
+      # runs on a _preparer thread
+      try:
+         clist.prepare()
+      except Exception as e:
+         print("Could not pre-roll {}: {}".format(clist.songname, e))
+
    def getSong (self, song = None, skip = None):
+      # songs picked explicitly (special victory anthems) may have been folded out, so look in all songs
       if song is not None:
-         for clist in self.clists:
+         for clist in self.allClists:
             if song == clist:
                return clist
       # if warcry mode is active, check for randomised warcry songs
-      if self.warcry:
-         warcrySongs = [c for c in self.clists if c.warcry and c is not skip]
-         if warcrySongs and all(c.randomise for c in warcrySongs):
+      if self.warcry and self.warcryRandom:
+         warcrySongs = self.warcrySongs
+         if skip is not None and skip in warcrySongs:
+            warcrySongs = [c for c in warcrySongs if c is not skip]
+         if warcrySongs:
             return random.choice(warcrySongs)
-      # iterate over songs with while loop
-      i = 0
-      while i < len(self.clists):
+      # after a warcry, warcry songs can't be picked, so don't check them at all
+      order = self.warcryOrder if self.warcry else self.regularOrder
+      for clist in order:
          # skip the song that just ended (advance instruction)
-         if self.clists[i] is skip:
-            i += 1
+         if clist is skip:
             continue
-         # try to check the condition list
-         try:
-            checked = self.clists[i].check(self.game)
-         # if a song will no longer be played, check will raise UnloadSong
-         except UnloadSong:
-            # disable the ConditionListPlayer, closing the song file
-            self.clists[i].disable()
-            # deleted
-            del self.clists[i]
-            # do not increment i, self.clists[i] is now the next song; continue
-            continue
-         # if randomise is true, check if all other songs have randomise true as well
-         # do not count warcry songs
-         if self.clists[i].randomise and not self.clists[i].warcry:
-            f, randomSong = 0, True
-            while f < len(self.clists):
-               # if one of them is false and they're not a warcry, do not play a random song
-               if not self.clists[f].randomise and not self.clists[f].warcry and self.clists[i].pname == self.clists[f].pname:
-                  randomSong = False
-                  break
-               f += 1
-            if randomSong:
-               # copy the entire song list of that team
-               x, randomList = 0, self.clists.copy()
-               while x < len(randomList):
-                  # traverse through and remove all songs that are not associated with the player clicked
-                  # remove all warcry songs from the list as well
-                  if self.clists[i].pname != randomList[x].pname or randomList[x].warcry:
-                     randomList.pop(x)
-                  else:
-                     x += 1
-               # reset the warcry variable so that warcry will play again when button is pressed
-               self.warcry = True
-               # return a randomly chosen song from the modified copied list
-               return random.choice(randomList)
+         # songs without conditions don't need checking
+         if id(clist) in self.unconditional and not clist.disabled:
+            checked = True
+         else:
+            # try to check the condition list
+            try:
+               checked = clist.check(self.game)
+            # if a song will no longer be played, check will raise UnloadSong
+            except UnloadSong:
+               # disable the ConditionListPlayer, closing the song file; order is not
+               # modified, as unload() builds new index lists
+               self.unload(clist)
+               continue
+         # if randomise is true and all other songs for this player have randomise true as well,
+         # play a random (non-warcry) song for this player
+         if clist.randomise and not clist.warcry and clist.pname in self.randomPools:
+            # reset the warcry variable so that warcry will play again when button is pressed
+            self.warcry = True
+            return random.choice(self.randomPools[clist.pname])
          # if conditions were met
          if checked:
-            # if warcry is enabled, play the first song found, warcry included
-            if self.warcry:
-               return self.clists[i]
-            # if a warcry has been played, play the first non-warcry song found
-            else:
-               if not self.clists[i].warcry:
-                  # reset the warcry variable so that warcry will play again when button is pressed
-                  self.warcry = True
-                  return self.clists[i]
-         # if the song didn't succeed, move to the next
-         i += 1
+            # reset the warcry variable so that warcry will play again when button is pressed
+            # (order only contains non-warcry songs when a warcry has already been played)
+            if not clist.warcry:
+               self.warcry = True
+            return clist
       # fallback: if no valid song was found, play the first non-warcry song
       # that isn't the skipped one (advance instruction)
       if skip is not None:
-         i = 0
-         while i < len(self.clists):
-            if self.clists[i] is skip:
-               i += 1
-               continue
-            if not self.clists[i].warcry:
+         for clist in self.regularOrder:
+            if clist is not skip:
                self.warcry = True
-               return self.clists[i]
-            i += 1
+               return clist
          # final fallback: play the skipped song itself
          self.warcry = True
          return skip
       # if no song was found, return nothing
       return None
 
-   def playSong (self, song = None, skip = None):
+   def playSong (self, song = None, skip = None, fadeIn = None):
+      pressed = time.perf_counter()
       # don't play multiple songs at once
       self.pauseSong()
       # get the song to play
@@ -509,75 +957,70 @@ class PlayerManager:
       # a returnable value for whether this is the first time this song is played
       self.firstTime = self.song.firstPlay
       # play the song
-      self.song.play()
+      self.song.play(pressed, fadeIn)
       # start blinking if the playing song is louder-marked
       if hasattr(self.song, 'louder') and self.song.louder:
          frame = self.master.frame
          if hasattr(frame, 'hasLouder') and frame.hasLouder:
             frame.startBlinking()
-      # start the end checker instruction thread
+      # run end instructions and manual looping when the song reaches its end
       if len(self.song.instructionsEnd) > 0 or (self.song.repeat and self.song.manualLoop):
-         self.endChecker = threading.Thread(target=self.checkEnd)
-         self.endChecker.start()
+         self.song.onEnd(self.songEnded)
       # remove any data specific to this goal
       self.game.clearButtonFlags()
       # if the song is the victory anthem and not a warcry, start victory song duration timer
-      if self.clists[0].pname == "victory" and not self.song.warcry:
+      if self.pname == "victory" and not self.song.warcry:
          self.master.timer.retrieveSongInfo()
 
       # check if user has enabled write to title.log function
       if not self.song.warcry and settings.config["write_song_title_log"] > 0:
-         global titleThread
-         global titleCheck
-         # if title timer thread already exists,
-         # kill it and wait for it to die before creating a new one
-         if titleCheck:
-            titleCheck = False
-            titleThread.join()
-         titleThread = threading.Thread(target=self.writeTitleLog)
-         titleThread.start()
+         # the new song's title replaces the previous one's, if it's still shown
+         if PlayerManager.titleLog is not None:
+            PlayerManager.titleLog.cancel()
+         PlayerManager.titleLog = dispatcher.run(self.writeTitleLog(self.song))
 
       return self.firstTime
 
-   def pauseSong (self):
+   def pauseSong (self, callback = None):
+      """Pauses the playing song, fading it out if its type fades; callback runs once it's paused (see ConditionPlayer.pause())."""
       if self.song is not None:
          # stop blinking when a louder-marked song is paused
          frame = self.master.frame
          if hasattr(frame, 'hasLouder') and frame.hasLouder:
             frame.stopBlinking()
-         # clear end checker thread to prevent continuous running while paused
-         self.endChecker = None
+         # stop handling the end of the song while it's paused
+         self.song.removeEnd(self.songEnded)
          # log pause
          print("Pausing",self.song.songname)
          # pause the song
-         self.song.pause()
+         self.song.pause(callback=callback)
          # clear self.song
          self.lastSong = self.song
          self.song = None
+      elif callback is not None:
+         callback()
 
-   def checkEnd (self):
-      while self.endChecker is not None:
-         if self.song.song.eof_reached:
-            if len(self.song.instructionsEnd) > 0:
-               for instruction in self.song.instructionsEnd:
-                  instruction.run(self)
-               break
-
-            if self.song.repeat and self.song.manualLoop:
-               self.song.song.time_pos = 0
-               sleep(0.05)
-               self.song.song.pause = False
-               self.song.song.volume = self.song._toMpvVolume(self.song.maxVolume)
-               for instruction in self.song.instructionsStart:
-                  instruction.run(self.song)
-               continue
-         time.sleep(0.01)
+   # runs on the dispatcher thread when the playing song reaches the end of its file
+   def songEnded (self, song):
+      # ignore songs that were paused or replaced since the end was reported
+      if song is not self.song:
+         return
+      if len(song.instructionsEnd) > 0:
+         song.removeEnd(self.songEnded)
+         for instruction in song.instructionsEnd:
+            instruction.run(self)
+         return
+      if song.repeat and song.manualLoop:
+         song.song.time_pos = 0
+         song.song.pause = False
+         song.song.volume = song._toMpvVolume(song.maxVolume)
+         for instruction in song.instructionsStart:
+            instruction.run(song)
 
    # if the song is currently playing or has been played, reset it
    def resetLastPlayed (self):
       if self.lastSong is not None or self.song is not None:
          self.pauseSong()
-         self.lastSong.song.command("stop")
          self.lastSong.reloadSong()
 
    # in-place reset: pauses any playing song and seeks it back to the start
@@ -586,29 +1029,36 @@ class PlayerManager:
       if self.song is not None:
          self.pauseSong()
       if self.lastSong is not None:
-         self.lastSong.song.time_pos = 0
-         self.lastSong.firstPlay = True
-         _position_cache.pop(abspath(self.lastSong.songname), None)
+         self.lastSong.rewind()
          self.lastSong = None
       self.warcry = True
 
-   # writes currently playing song's details to title.log, clearing it after a set amount of time
-   def writeTitleLog (self):
-      print("Write title timer thread started.")
-      global titleThread
-      global titleCheck
-      titleCheck = True
+   # writes currently playing song's details to title.log, clearing it after a set amount of time;
+   # runs as a task on the dispatcher, cancelled when another song's title replaces it
+   async def writeTitleLog (self, song):
+      print("Write title timer task started.")
       # sleep delay needed for mpv to properly retrieve metadata
-      sleep(1)
-      # exit thread if it has been interrupted early
-      if titleThread is None or not titleCheck:
-         print("Write title timer thread ended early.")
-         titleThread = None
-         titleThread = False
+      await asyncio.sleep(1)
+      # exit if the song was paused in the meantime
+      if self.song is not song or not isinstance(song.song, mpv.MPV):
+         print("Write title timer task ended early.")
          return
+      try:
+         self._writeTitle(song)
+         timerStart = time.monotonic()
+         # wait until the song has ended or timer has run out
+         while (self.song is song and isinstance(song.song, mpv.MPV) and not song.song.eof_reached and
+               (time.monotonic() - timerStart) <= settings.config["write_song_title_log"]):
+            await asyncio.sleep(0.1)
+      finally:
+         # clear title.log, also when interrupted by the next song or by closing rigdio
+         print("Write title timer task ended.")
+         with open("title.log", 'w') as file:
+            file.write("")
 
+   def _writeTitle (self, song):
       # get metadata title and artist
-      metadata = self.song.song.metadata or {}
+      metadata = song.song.metadata or {}
       title = metadata.get("title")
       artist = metadata.get("artist")
       # music note to signify it's music or something (idk, it was requested)
@@ -628,28 +1078,112 @@ class PlayerManager:
             file.write(text)
       # if title could not be written in for some reason, use the filename instead
       except:
-         path = self.song.song.path or ""
+         path = song.song.path or ""
          text += splitext(basename(path))[0]
          with open("title.log", 'w', encoding='utf8') as file:
             file.write(text)
 
-      timerStart = time.time()
-      while titleThread is not None:
-         # exit loop if thread has been interrupted, song has ended, or timer has run out
-         if (not titleCheck or self.song is None or
-               self.song.song.eof_reached or
-               (time.time() - timerStart) > settings.config["write_song_title_log"]):
-            break
-         time.sleep(0.01)
-
-      # clear title.log and exit thread
-      print("Write title timer thread ended.")
-      with open("title.log", 'w') as file:
-         file.write("")
-      titleThread = None
-      titleCheck = False
-
-# global variables for the title timer thread
-# required as they need to be accessed across different PlayerManager instances
-titleThread = None
-titleCheck = False
+class ChaosMixer:
+   """
+      Plays many songs at once (chaoshorn) on a single mpv core, mixed by a lavfi-complex graph.
+
+      The first song is loaded as the core's file and the rest as extra audio tracks. Each track
+      goes through its own chain (start instruction, normalization gain and volume slider) into an
+      amix, so the whole chaoshorn costs one mpv, one audio output and no end of file observers,
+      instead of a core, output and observer for every song.
+   """
+   # seconds to wait for mpv to open the songs
+   loadTimeout = 10
+
+   def __init__ (self, songs):
+      # ConditionPlayers to mix
+      self.songs = songs
+      self.core = None
+
+   def evictable (self):
+      # called by the pool; the mixer gives its core back itself in stop()
+      return False
+
+   def evicted (self):
+      pass
+
+   def prime (self, callback):
+      """
+         Analyzes the loudness of every song in the mix on the background workers, then calls
+         callback (from a worker thread, or straight away if there's nothing to analyze), after
+         which play() only reads the cache.
+      """
+      if not settings.config["normalize_volume"]:
+         callback()
+         return
+      songnames = [song.songname for song in self.songs]
+      start_background_analysis(songnames, settings.level["target"], callback,
+         [PRIORITY_ANTHEM] * len(songnames), [song.startTime / 1000.0 for song in self.songs])
+
+   def play (self, speed = 1.0):
+      """Starts the mix. Raises an exception, after giving the core back, if mpv can't play it."""
+      if not self.songs:
+         raise SongNotFound("chaoshorn")
+      songnames = [abspath(song.songname) for song in self.songs]
+      # normalization analyzes any song prime() hasn't, so call play() once it's done
+      chains = [song.filterChain() for song in self.songs]
+      self.core = _mpv_pool.acquire(self)
+      try:
+         self.core["audio-files"] = songnames[1:]
+         self.core.loadfile(songnames[0])
+         self.core.wait_for_property("duration", timeout=ChaosMixer.loadTimeout)
+         tracks = self.trackIds(songnames)
+         if not tracks:
+            raise SongNotFound("chaoshorn")
+         self.core["lavfi-complex"] = self.graph(tracks, chains)
+         self.core.speed = speed
+         self.core.pause = False
+      except Exception:
+         self.stop()
+         raise
+      print("Playing chaoshorn: {} songs mixed on one mpv core.".format(len(tracks)))
+
+   def trackIds (self, songnames):
+      # returns (song index, track id) for the first audio track of every song mpv could open;
+      # the first song's tracks are the file's own, the others are external
+      tracks = [track for track in self.core.track_list if track.get("type") == "audio"]
+      found = []
+      for i, songname in enumerate(songnames):
+         for track in tracks:
+            if (track.get("external-filename") == songname) if i > 0 else not track.get("external"):
+               # the same song may be in the mix twice, so each track is only used once
+               tracks.remove(track)
+               found.append((i, track["id"]))
+               break
+         else:
+            print("Chaoshorn could not open {}".format(songname))
+      return found
+
+   def graph (self, tracks, chains):
+      # builds the lavfi-complex graph mixing the given tracks into the audio output
+      parts = []
+      for n, (i, trackId) in enumerate(tracks):
+         song = self.songs[i]
+         filters = []
+         if song.startTime > 0:
+            filters.append("atrim=start={:.3f},asetpts=PTS-STARTPTS".format(song.startTime / 1000.0))
+         if chains[i]:
+            filters.append(chains[i])
+         # mpv's volume is cubic, see ConditionPlayer._toMpvVolume
+         filters.append("volume={:.4f}".format((song._toMpvVolume(song.maxVolume) / 100) ** 3))
+         parts.append("[aid{}] {} [mix{}]".format(trackId, ",".join(filters), n))
+      # amix divides every input by the number of inputs; unrelated songs add up in power rather
+      # than amplitude, so the mix is brought back up by the square root of that and limited
+      parts.append("{} amix=inputs={}:duration=longest,volume={:.3f},alimiter=limit=0.95 [ao]".format(
+         "".join("[mix{}]".format(n) for n in range(len(tracks))), len(tracks), math.sqrt(len(tracks))))
+      return "; ".join(parts)
+
+   def stop (self):
+      """Stops the mix and gives the core back to the pool."""
+      core, self.core = self.core, None
+      if core is None:
+         return
+      core.command("stop")
+      core["lavfi-complex"] = ""
+      core["audio-files"] = []
+      _mpv_pool.release(self)
@@ -0,0 +1,87 @@
+import os
+import threading
+from os.path import join, splitext, relpath
+
+from config import settings
+from loudness import start_background_analysis, primeLoudness, loudnessMeasurements
+from rigparse import readTeam, validateTeam, saveBundle
+from bundle import bundleSongs, isCurrent
+
+class TeamLibrary:
+   """
+      Folder of team exports for tournament days, prepared in the background at startup.
+
+      Every .4ccm in the folder (including subfolders) is read, its songs looked up, its conditions
+      checked and its songs' loudness analysed, so that a team picked from the library loads without
+      reading or analysing anything again. Only the compiled entries are kept in memory; songs only
+      open an mpv core once they're played, as with any other team.
+   """
+   def __init__ (self, folder):
+      self.folder = folder
+      self.lock = threading.Lock()
+      # export file : compiled team (see bundle.compileBundle()), for teams that are ready
+      self.teams = {}
+      # export file : error message, for teams that couldn't be prepared
+      self.errors = {}
+      self.exports = self.findExports()
+
+   def findExports (self):
+      exports = []
+      for root, dirs, files in os.walk(self.folder):
+         dirs.sort()
+         for name in sorted(files):
+            if splitext(name)[1].lower() == ".4ccm":
+               exports.append(join(root, name).replace("\\", "/"))
+      return exports
+
+   def start (self):
+      thread = threading.Thread(target=self.prepareAll, daemon=True)
+      thread.start()
+
+   def prepareAll (self):
+      print("Preparing {} team(s) from tournament library {}.".format(len(self.exports), self.folder))
+      for filename in self.exports:
+         self.prepare(filename)
+      print("Tournament library ready.")
+
+   def prepare (self, filename):
+      try:
+         team, saved = readTeam(filename)
+         validateTeam(filename, team)
+      except Exception as e:
+         print("Could not prepare {} for the tournament library: {}".format(filename, e))
+         with self.lock:
+            self.errors[filename] = str(e)
+         return
+      with self.lock:
+         self.teams[filename] = team
+         self.errors.pop(filename, None)
+      if settings.config["normalize_volume"]:
+         songs = bundleSongs(team)
+         measured = len(team["loudness"])
+         primeLoudness(team["loudness"], settings.level["target"])
+         # analyse one team at a time, behind every song of the loaded teams
+         done = threading.Event()
+         start_background_analysis(songs, settings.level["target"], done.set)
+         done.wait()
+         saved = saved and len(loudnessMeasurements(songs)) == measured
+      if not saved:
+         saveBundle(filename, team)
+
+   def team (self, filename):
+      """Returns the compiled team for an export if it's ready and none of its files changed, otherwise None."""
+      with self.lock:
+         team = self.teams.get(filename)
+      if team is not None and isCurrent(team, filename, settings.config["normalize_volume"]):
+         return team
+      return None
+
+   def describe (self, filename):
+      """Returns the text shown for an export in the library picker."""
+      name = relpath(filename, self.folder).replace("\\", "/")
+      with self.lock:
+         if filename in self.errors:
+            return "{} (error: {})".format(name, self.errors[filename])
+         if filename in self.teams:
+            return "/{}/ ({})".format(self.teams[filename]["tname"], name)
+      return "{} (preparing...)".format(name)
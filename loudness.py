@@ -0,0 +1,1017 @@
+import os
+import re
+import sys
+import time
+import json
+import math
+import hashlib
+import heapq
+import itertools
+import tempfile
+import threading
+import subprocess
+from os.path import abspath, basename, getsize, isfile
+from concurrent.futures import Future
+
+from config import settings
+from rigdio_except import LoudnessError
+
+# numpy is optional; without it the pcm backend is unavailable
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+# name of the persistent loudness store, kept next to config.yml
+STORE_FILE = "loudness.cache"
+# bytes read from each end of a file for the partial content hash
+HASH_CHUNK = 65536
+# seconds before giving up on analysing a single file
+ANALYSIS_TIMEOUT = 30
+# seconds to wait for another thread analysing the same file, enough for every backend to time out
+ANALYSIS_WAIT = 3*ANALYSIS_TIMEOUT
+# seconds decoded in each window when estimating the loudness of a long track
+ESTIMATE_WINDOW = 5.0
+# seconds of audio covered by each ANALYSIS_TIMEOUT when a long track is measured in full
+TIMEOUT_SPAN = 300
+# times measuring an estimated track in full is tried before settling for the estimate
+REFINE_ATTEMPTS = 3
+
+def fileStamp (fullpath):
+   """Returns the (size, mtime) pair used to detect changes to a song file."""
+   stat = os.stat(fullpath)
+   return stat.st_size, stat.st_mtime_ns
+
+def partialHash (fullpath):
+   """
+      Hashes the first and last HASH_CHUNK bytes of a file along with its size.
+
+      Cheap enough to run on every stored song, and lets the store recognise a song that was
+      copied or re-extracted (new mtime) without decoding it again.
+   """
+   size = getsize(fullpath)
+   digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+   with open(fullpath, "rb") as f:
+      digest.update(f.read(HASH_CHUNK))
+      if size > 2*HASH_CHUNK:
+         f.seek(-HASH_CHUNK, os.SEEK_END)
+         digest.update(f.read(HASH_CHUNK))
+   return digest.hexdigest()
+
+class LoudnessStore:
+   """
+      Persistent store of loudness measurements, as a JSON-lines file.
+
+      Entries are keyed by absolute path and validated against the file's size and mtime, falling
+      back to a partial content hash when only the mtime changed. Raw measurements (mean and peak
+      volume, plus integrated loudness and true peak once measured in LUFS mode) are stored rather
+      than gains, so changing the target level never requires the songs to be analysed again; the
+      gain is simply recalculated from the stored measurement.
+
+      Thread-safe: lookups and writes may come from any analysis worker.
+   """
+   def __init__ (self, filename = STORE_FILE):
+      self.filename = filename
+      self.entries = None
+      self.lock = threading.Lock()
+
+   def _load (self):
+      # must be called with self.lock held
+      if self.entries is not None:
+         return
+      self.entries = {}
+      lines = 0
+      try:
+         with open(self.filename, encoding="utf8") as f:
+            for line in f:
+               lines += 1
+               try:
+                  entry = json.loads(line)
+                  # later lines override earlier ones for the same path
+                  self.entries[entry["path"]] = entry
+               except (ValueError, KeyError, TypeError):
+                  # ignore lines cut off by a crash mid-write
+                  continue
+      except FileNotFoundError:
+         return
+      except Exception as e:
+         print("Error reading loudness cache {}: {}".format(self.filename, e))
+         return
+      # rewrite the file if it's mostly superseded entries
+      if lines > 2*len(self.entries) + 100:
+         self._compact()
+
+   def _compact (self):
+      # must be called with self.lock held
+      temp = self.filename + ".tmp"
+      try:
+         with open(temp, "w", encoding="utf8") as f:
+            for entry in self.entries.values():
+               f.write(json.dumps(entry) + "\n")
+         os.replace(temp, self.filename)
+      except Exception as e:
+         print("Error compacting loudness cache {}: {}".format(self.filename, e))
+
+   def _append (self, entry):
+      # must be called with self.lock held
+      self.entries[entry["path"]] = entry
+      try:
+         with open(self.filename, "a", encoding="utf8") as f:
+            f.write(json.dumps(entry) + "\n")
+      except Exception as e:
+         print("Error writing loudness cache {}: {}".format(self.filename, e))
+
+   def lookup (self, filepath):
+      """Returns the stored measurement for a file (see LoudnessBackend.measure()), or None if unknown or the file changed."""
+      fullpath = abspath(filepath)
+      if not isfile(fullpath):
+         return None
+      with self.lock:
+         self._load()
+         entry = self.entries.get(fullpath)
+         if entry is None:
+            return None
+         size, mtime = fileStamp(fullpath)
+         if entry["size"] != size:
+            return None
+         if entry["mtime"] != mtime:
+            # same size but touched; only trust the entry if the content looks the same
+            if entry.get("hash") is None or entry["hash"] != partialHash(fullpath):
+               return None
+            entry = dict(entry, mtime=mtime)
+            self._append(entry)
+         if "lufs" in entry:
+            return entry["mean"], entry["max"], entry["lufs"], entry["peak"]
+         return entry["mean"], entry["max"]
+
+   def store (self, filepath, measured):
+      """Records a measurement for a file, stamped with its current size, mtime and partial hash."""
+      fullpath = abspath(filepath)
+      try:
+         size, mtime = fileStamp(fullpath)
+         digest = partialHash(fullpath)
+      except OSError:
+         return
+      entry = {"path": fullpath, "size": size, "mtime": mtime, "hash": digest, "mean": measured[0], "max": measured[1]}
+      if len(measured) > 2:
+         entry["lufs"], entry["peak"] = measured[2], measured[3]
+      with self.lock:
+         self._load()
+         self._append(entry)
+
+def _popenKwargs ():
+   # keyword arguments for every ffmpeg subprocess; hides the console window on Windows,
+   # and runs background analysis at a lower priority (on Linux, worker threads are already reniced)
+   kwargs = {}
+   if os.name == "nt":
+      kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW
+      niceness = settings.level["niceness"]
+      if getattr(_background, "worker", False) and niceness > 0:
+         if niceness >= 15:
+            kwargs["creationflags"] |= subprocess.IDLE_PRIORITY_CLASS
+         else:
+            kwargs["creationflags"] |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
+   return kwargs
+
+# set on analysis queue worker threads
+_background = threading.local()
+# limits how many decoders run at once; created on first use from level:processes
+_decoders = None
+_decoders_lock = threading.Lock()
+
+def _cpuCount ():
+   return os.cpu_count() or 2
+
+def _cpuLoad ():
+   # number of busy cores, or None where the load average isn't available (Windows)
+   try:
+      return os.getloadavg()[0]
+   except (AttributeError, OSError):
+      return None
+
+def analysisWorkers (running = 0):
+   """
+      Returns how many files to analyze at once in the background: level:workers, or for auto,
+      the cores not busy with other programs (not counting the running analysis workers). Where
+      the load can't be measured, auto uses half the cores.
+   """
+   workers = settings.level["workers"]
+   if workers != "auto":
+      return workers
+   cpus = _cpuCount()
+   load = _cpuLoad()
+   if load is None:
+      return max(1, cpus // 2)
+   return max(1, min(cpus, round(cpus - max(0, load - running))))
+
+def decoderSlots ():
+   """
+      Returns the semaphore limiting how many analysis queue workers decode at once (level:processes).
+
+      A worker takes its slot before claiming a file (see AnalysisQueue._work()), so a song played
+      while the worker waits for a slot analyzes the file itself rather than waiting behind it.
+      Songs played before the queue got to them never take a slot.
+   """
+   global _decoders
+   with _decoders_lock:
+      if _decoders is None:
+         processes = settings.level["processes"]
+         _decoders = threading.BoundedSemaphore(_cpuCount() if processes == "auto" else processes)
+      return _decoders
+
+def _lowerThreadPriority ():
+   # on Linux niceness is per thread and inherited by the threads and processes it starts,
+   # which covers mpv's decoder threads and ffmpeg as well as this thread
+   niceness = settings.level["niceness"]
+   if niceness > 0 and sys.platform.startswith("linux"):
+      try:
+         os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), min(niceness, 19))
+      except OSError as e:
+         print("Could not lower the priority of loudness analysis: {}".format(e))
+
+# ffmpeg filter measuring integrated loudness and true peak; frames are only logged at verbose level,
+# so the summary at the end is all that's printed
+EBUR128_FILTER = "ebur128=peak=true:framelog=verbose"
+
+def measuringLufs ():
+   """Checks whether songs are normalized on integrated loudness (level:measure is lufs) rather than mean volume."""
+   return settings.level["measure"] == "lufs"
+
+def _decibels (text):
+   # parses a level printed by ffmpeg, which may be -inf for silence
+   return max(-91.0, float(text))
+
+def _parseEbur128 (text):
+   # returns (integrated LUFS, true peak dBTP) from the summary ebur128 prints, or None
+   integrated = re.search(r"Integrated loudness:\s*I:\s*(-?[\d.]+|-inf) LUFS", text)
+   peak = re.search(r"True peak:\s*Peak:\s*(-?[\d.]+|-inf) dBFS", text)
+   if integrated is None or peak is None:
+      return None
+   return _decibels(integrated.group(1)), _decibels(peak.group(1))
+
+def _rangeArgs (start, length):
+   # ffmpeg arguments decoding only part of the file; -ss goes before -i so it seeks instead of decoding up to start
+   args = []
+   if start:
+      args += ["-ss", "{:.3f}".format(start)]
+   if length is not None:
+      args += ["-t", "{:.3f}".format(length)]
+   return args
+
+class LoudnessBackend:
+   """
+      Measures the mean and peak volume of a song file.
+
+      Backends are listed in the backends dict below and selected with settings.level["backend"];
+      analyze_loudness falls back to the next available backend if one fails.
+   """
+   # whether measuring a file starts a process, which is worth batching (see batchSize())
+   spawns = False
+
+   def available (self):
+      """
+         Checks whether this backend can run at all (e.g. its libraries are installed).
+      """
+      return True
+
+   def measure (self, fullpath, start = 0, length = None, timeout = ANALYSIS_TIMEOUT):
+      """
+         Returns (mean_db, max_db) for the file, in dBFS. Raises LoudnessError on failure,
+         including when decoding takes longer than timeout seconds.
+
+         When measuring LUFS (see measuringLufs()), the integrated loudness and true peak are
+         measured in the same pass and returned after them: (mean_db, max_db, lufs, peak_db).
+         If length is given, only that many seconds from start are measured.
+      """
+      raise NotImplementedError("LoudnessBackend subclass must override measure().")
+
+   def duration (self, fullpath):
+      """
+         Returns the length of the file in seconds, or None if it can't be told. By default, read
+         from the header ffmpeg prints when opening the file.
+      """
+      try:
+         result = subprocess.run(["ffmpeg", "-hide_banner", "-i", fullpath], capture_output=True, text=True,
+            errors="replace", timeout=ANALYSIS_TIMEOUT, **_popenKwargs())
+      except (OSError, subprocess.TimeoutExpired):
+         return None
+      # ffmpeg exits with an error without an output file, but has printed the header by then
+      match = re.search(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+      if match is None:
+         return None
+      return 3600*int(match.group(1)) + 60*int(match.group(2)) + float(match.group(3))
+
+class MpvBackend (LoudnessBackend):
+   """
+      Decodes in-process through libmpv, which rigdio already loads for playback.
+
+      The file is run through an astats filter (and ebur128, when measuring LUFS) on a silent mpv
+      core with untimed output, so it decodes as fast as possible without spawning a process; the
+      levels are read back from the filter metadata once the end of the file is reached.
+   """
+   label = "rigdio_stats"
+
+   def available (self):
+      try:
+         import mpv
+      except (ImportError, OSError):
+         return False
+      return True
+
+   def measure (self, fullpath, start = 0, length = None, timeout = ANALYSIS_TIMEOUT):
+      import mpv
+      lufs = measuringLufs()
+      graph = "astats=metadata=1:reset=0,ebur128=metadata=1:peak=true" if lufs else "astats=metadata=1:reset=0"
+      player = mpv.MPV(vid=False, ao="null", ao_null_untimed=True, keep_open=True,
+         af="@{}:lavfi=[{}]".format(MpvBackend.label, graph))
+      options = {}
+      if start:
+         options["start"] = "{:.3f}".format(start)
+      if length is not None:
+         options["length"] = "{:.3f}".format(length)
+      try:
+         player.loadfile(fullpath, **options)
+         player.wait_for_property("eof-reached", timeout=timeout)
+         stats = player["af-metadata/{}".format(MpvBackend.label)] or {}
+      except TimeoutError:
+         raise LoudnessError(fullpath, "timed out")
+      finally:
+         player.terminate()
+      try:
+         measured = _decibels(stats["lavfi.astats.Overall.RMS_level"]), _decibels(stats["lavfi.astats.Overall.Peak_level"])
+      except (KeyError, ValueError):
+         raise LoudnessError(fullpath, "no astats metadata from mpv")
+      if not lufs:
+         return measured
+      # true peaks are linear, per channel
+      peaks = [float(value) for key, value in stats.items() if key.startswith("lavfi.r128.true_peaks_ch")]
+      if "lavfi.r128.I" not in stats or not peaks:
+         raise LoudnessError(fullpath, "no ebur128 metadata from mpv")
+      peak = max(peaks)
+      return measured + (_decibels(stats["lavfi.r128.I"]), 20 * math.log10(peak) if peak > 0 else -91.0)
+
+   def duration (self, fullpath):
+      import mpv
+      player = mpv.MPV(vid=False, ao="null", pause=True)
+      try:
+         player.loadfile(fullpath)
+         player.wait_for_property("duration", timeout=ANALYSIS_TIMEOUT)
+         return player.duration
+      except TimeoutError:
+         return None
+      finally:
+         player.terminate()
+
+class PcmBackend (LoudnessBackend):
+   """
+      Streams raw 16-bit PCM from an ffmpeg decode pipe and measures it with numpy.
+
+      Samples are processed in fixed-size blocks, so memory use doesn't depend on song length.
+      The results match volumedetect, which also works on 16-bit samples. When measuring LUFS,
+      the same ffmpeg process runs ebur128 on the way and reports it when it exits.
+   """
+   blockSize = 1 << 18
+   spawns = True
+
+   def available (self):
+      return numpy is not None
+
+   def measure (self, fullpath, start = 0, length = None, timeout = ANALYSIS_TIMEOUT):
+      lufs = measuringLufs()
+      if lufs:
+         # the summary goes to a file rather than a pipe nobody reads until the end
+         log = tempfile.TemporaryFile()
+         command = ["ffmpeg", "-v", "info", "-hide_banner", "-nostats", "-vn"] + _rangeArgs(start, length) + ["-i", fullpath, "-af", EBUR128_FILTER]
+      else:
+         log = subprocess.DEVNULL
+         command = ["ffmpeg", "-v", "error", "-vn"] + _rangeArgs(start, length) + ["-i", fullpath]
+      process = subprocess.Popen(
+         command + ["-f", "s16le", "-acodec", "pcm_s16le", "-"],
+         stdout=subprocess.PIPE, stderr=log, **_popenKwargs()
+      )
+      # kill ffmpeg if it stalls, which also ends the read loop below
+      watchdog = threading.Timer(timeout, process.kill)
+      watchdog.start()
+      count, squares, peak = 0, 0.0, 0.0
+      try:
+         leftover = b""
+         while True:
+            block = process.stdout.read(PcmBackend.blockSize)
+            if not block:
+               break
+            block = leftover + block
+            # keep any odd byte for the next block so samples stay aligned
+            cut = len(block) & ~1
+            leftover = block[cut:]
+            samples = numpy.frombuffer(block[:cut], dtype="<i2").astype(numpy.float64)
+            if samples.size == 0:
+               continue
+            count += samples.size
+            squares += float(numpy.dot(samples, samples))
+            peak = max(peak, float(numpy.abs(samples).max()))
+         process.wait()
+      finally:
+         watchdog.cancel()
+         process.stdout.close()
+         if lufs:
+            log.seek(0)
+            report = log.read().decode("utf8", "replace")
+            log.close()
+      if process.returncode != 0 or count == 0:
+         raise LoudnessError(fullpath, "ffmpeg decode failed")
+      mean_db = 10 * math.log10(squares / count / 32768**2) if squares > 0 else -91.0
+      max_db = 20 * math.log10(peak / 32768) if peak > 0 else -91.0
+      measured = round(mean_db, 1), round(max_db, 1)
+      if not lufs:
+         return measured
+      loudness = _parseEbur128(report)
+      if loudness is None:
+         raise LoudnessError(fullpath, "could not parse ebur128 output")
+      return measured + loudness
+
+class VolumedetectBackend (LoudnessBackend):
+   """
+      Runs ffmpeg's volumedetect filter (followed by ebur128, when measuring LUFS) in a subprocess
+      and parses its report. Always available as the last resort, as ffmpeg ships with rigdio.
+   """
+   spawns = True
+
+   def measure (self, fullpath, start = 0, length = None, timeout = ANALYSIS_TIMEOUT):
+      lufs = measuringLufs()
+      filters = "volumedetect," + EBUR128_FILTER if lufs else "volumedetect"
+      try:
+         result = subprocess.run(
+            ["ffmpeg", "-vn"] + _rangeArgs(start, length) + ["-i", fullpath, "-af", filters, "-f", "null", "-"],
+            capture_output=True, text=True, errors="replace", timeout=timeout, **_popenKwargs()
+         )
+      except FileNotFoundError:
+         raise LoudnessError(fullpath, "ffmpeg not found")
+      except subprocess.TimeoutExpired:
+         raise LoudnessError(fullpath, "timed out")
+      return self._parse(fullpath, result.stderr, lufs)
+
+   def measureBatch (self, fullpaths):
+      """
+         Measures many files with a single ffmpeg process, with a volumedetect chain for each input
+         and a null output for each chain. Returns the measurements read from the report, keyed by
+         path; ffmpeg gives up on the whole batch if any input can't be opened, so files may be
+         missing from it.
+      """
+      lufs = measuringLufs()
+      chain = "volumedetect," + EBUR128_FILTER if lufs else "volumedetect"
+      command = ["ffmpeg", "-hide_banner", "-nostats"]
+      for fullpath in fullpaths:
+         command += ["-i", fullpath]
+      command += ["-filter_complex", ";".join("[{0}:a:0]{1}[out{0}]".format(i, chain) for i in range(len(fullpaths)))]
+      for i in range(len(fullpaths)):
+         command += ["-map", "[out{}]".format(i), "-f", "null", "-"]
+      try:
+         result = subprocess.run(command, capture_output=True, text=True, errors="replace",
+            timeout=ANALYSIS_TIMEOUT*len(fullpaths), **_popenKwargs())
+      except (OSError, subprocess.TimeoutExpired) as e:
+         print("   Batched loudness analysis of {} files failed: {}".format(len(fullpaths), e))
+         return {}
+      # filters are named Parsed_<filter>_<n> in the order they appear in the graph, so each input's
+      # chain is the n-th group of filters; their reports are cut apart at those names
+      perChain = chain.count(",") + 1
+      parts = re.split(r"\[Parsed_\w+?_(\d+) @ [^\]]*\]", result.stderr)
+      reports = {}
+      for index, text in zip(parts[1::2], parts[2::2]):
+         reports.setdefault(int(index) // perChain, []).append(text)
+      measurements = {}
+      for i, fullpath in enumerate(fullpaths):
+         try:
+            measurements[fullpath] = self._parse(fullpath, "".join(reports.get(i, [])), lufs)
+         except LoudnessError:
+            continue
+      return measurements
+
+   def _parse (self, fullpath, report, lufs):
+      # reads the measurement of one file from the volumedetect (and ebur128) report
+      mean_match = re.search(r"mean_volume:\s*(-?[\d.]+)\s*dB", report)
+      max_match = re.search(r"max_volume:\s*(-?[\d.]+)\s*dB", report)
+      if not mean_match or not max_match:
+         raise LoudnessError(fullpath, "could not parse volumedetect output")
+      measured = float(mean_match.group(1)), float(max_match.group(1))
+      if not lufs:
+         return measured
+      loudness = _parseEbur128(report)
+      if loudness is None:
+         raise LoudnessError(fullpath, "could not parse ebur128 output")
+      return measured + loudness
+
+backends = {
+   "mpv" : MpvBackend(),
+   "pcm" : PcmBackend(),
+   "ffmpeg" : VolumedetectBackend()
+}
+
+# order tried when settings.level["backend"] is "auto"
+autoBackends = ["mpv", "pcm", "ffmpeg"]
+
+def batchSize ():
+   """Returns how many files a background analysis worker measures at once: level:batch when the
+   active backend starts an ffmpeg process for every file, else 1."""
+   active = activeBackends()
+   if settings.level["batch"] > 1 and active and active[0].spawns:
+      return settings.level["batch"]
+   return 1
+
+def activeBackends ():
+   """Lists the backends to try, in order: the configured one first, then ffmpeg as the fallback."""
+   choice = settings.level["backend"]
+   names = autoBackends if choice == "auto" else [choice, "ffmpeg"]
+   output = []
+   for name in names:
+      backend = backends.get(name)
+      if backend is not None and backend not in output and backend.available():
+         output.append(backend)
+   return output
+
+# Cache of loudness analysis results keyed by absolute file path.
+# Populated lazily by analyze_loudness when a song is played,
+# or proactively by start_background_analysis after loading.
+_loudness_cache = {}
+
+# Raw measurements (see LoudnessBackend.measure()) behind _loudness_cache, keyed the same way,
+# so they can be saved in compiled team bundles.
+_loudness_measured = {}
+
+# Length in seconds of files whose loudness so far is only estimated from a few windows
+# (see estimateLoudness), until refineLoudness measures the whole file or gives up on it.
+_loudness_estimated = {}
+
+# Failed attempts of refineLoudness, keyed the same way.
+_refine_failures = {}
+
+# Files currently being analyzed, each with a Future resolved with its result,
+# so that other threads wanting the same file wait for it instead of analyzing it again.
+_loudness_pending = {}
+_loudness_pending_lock = threading.Lock()
+
+# Persistent measurements shared across rigdio sessions, so a restart
+# doesn't re-analyze songs that were already measured.
+_loudness_store = LoudnessStore()
+
+def _usable(measured):
+   # LUFS mode needs measurements taken with ebur128; older ones only have the mean volume
+   return measured is not None and (len(measured) > 2 or not measuringLufs())
+
+def _loudnessGain(fullpath, measured, target_db):
+   """Calculates (gain_db, needs_limiter) for a measurement (see LoudnessBackend.measure()):
+   from the integrated loudness and true peak when measuring LUFS, else the mean and peak volume."""
+   if measuringLufs():
+      level, peak = measured[2], measured[3]
+      description = "integrated loudness of {:.1f} LUFS and true peak of {:.1f} dBTP".format(level, peak)
+      unit = "LUFS"
+   else:
+      level, peak = measured[0], measured[1]
+      description = "mean volume of {:.1f} dB and peak of {:.1f} dB".format(level, peak)
+      unit = "dB"
+   gain = target_db - level
+   needs_limiter = (peak + gain) > 0.0
+   print("   {} has {}, target is {:.1f} {}; applying {:.1f} dB gain{}.".format(
+      basename(fullpath), description, target_db, unit, gain, " with limiter" if needs_limiter else ""))
+   return gain, needs_limiter
+
+def measureLoudness(fullpath, timeout=ANALYSIS_TIMEOUT):
+   """Measures a file with the active backends, falling back on failure, giving each backend
+   timeout seconds. Returns the measurement (see LoudnessBackend.measure()), or None if no
+   backend could measure it."""
+   for backend in activeBackends():
+      try:
+         return backend.measure(fullpath, timeout=timeout)
+      except Exception as e:
+         print("   {} backend failed: {}".format(type(backend).__name__, e))
+   return None
+
+def probeDuration(fullpath):
+   """Returns the length of a file in seconds from the first backend that can tell, or None."""
+   for backend in activeBackends():
+      try:
+         duration = backend.duration(fullpath)
+      except Exception as e:
+         print("   {} backend could not get the length of {}: {}".format(type(backend).__name__, basename(fullpath), e))
+         continue
+      if duration:
+         return duration
+   return None
+
+def estimateLoudness(fullpath, start=0):
+   """Estimates the loudness of a long file from level:windows evenly spaced windows of
+   ESTIMATE_WINDOW seconds, taken from start (e.g. a goalhorn's start instruction) onward.
+   Returns (measurement, coverage, duration), where coverage is the fraction of the file from
+   start that was measured and duration its length in seconds, or None if the file is no longer than level:estimate seconds, its length
+   can't be told or no backend could measure it."""
+   threshold = settings.level["estimate"]
+   if threshold <= 0:
+      return None
+   duration = probeDuration(fullpath)
+   if duration is None:
+      return None
+   if start >= duration:
+      # a start instruction past the end plays nothing useful; estimate the whole file
+      start = 0
+   span = duration - start
+   if span <= threshold:
+      return None
+   count = settings.level["windows"]
+   length = min(ESTIMATE_WINDOW, span / count)
+   # centre each window in its share of the span
+   positions = [start + span * (i + 0.5) / count - length / 2 for i in range(count)]
+   for backend in activeBackends():
+      try:
+         windows = [backend.measure(fullpath, position, length) for position in positions]
+      except Exception as e:
+         print("   {} backend failed: {}".format(type(backend).__name__, e))
+         continue
+      # average the levels by power, as one long measurement would, and keep the highest peaks
+      combined = []
+      for i, values in enumerate(zip(*windows)):
+         if i % 2:
+            combined.append(max(values))
+         else:
+            power = sum(10 ** (value / 10) for value in values) / count
+            combined.append(round(10 * math.log10(power), 1) if power > 0 else -91.0)
+      return tuple(combined), count * length / span, duration
+   return None
+
+def analyze_loudness(filepath, target_db, start=0):
+   """Analyze audio loudness and calculate gain needed to reach target_db.
+   Returns (gain_db, needs_limiter) or (None, False) if no backend could measure the file.
+   A limiter is needed when the full gain would cause peak clipping.
+   Measurements are looked up in the persistent loudness store before decoding.
+   Thread-safe: a file is only analyzed by one thread at a time; other threads wanting it
+   wait up to ANALYSIS_WAIT seconds for its result. Unexpected errors are raised in every
+   waiting thread (TimeoutError if the wait runs out) and aren't cached, so the file can be
+   tried again.
+   Files longer than level:estimate seconds are only estimated (see estimateLoudness), from
+   start onward, and queued to be measured in full by refineLoudness at PRIORITY_IDLE.
+   A file that's part of a batch (see analyzeBatch) is analyzed again on the calling thread
+   rather than waiting for the whole batch, unless that's a background worker."""
+   fullpath = abspath(filepath)
+   # fast path: already cached
+   if fullpath in _loudness_cache:
+      return _loudness_cache[fullpath]
+   # claim this file or wait for another thread to finish it
+   with _loudness_pending_lock:
+      if fullpath in _loudness_cache:
+         return _loudness_cache[fullpath]
+      future = _loudness_pending.get(fullpath)
+      claimed = future is None
+      if claimed:
+         future = Future()
+         _loudness_pending[fullpath] = future
+   if not claimed:
+      if getattr(future, "batched", False) and not getattr(_background, "worker", False):
+         # a song being played doesn't wait for the rest of the batch; the batch's measurement
+         # replaces this one when it's done
+         return _analyzeClaimed(fullpath, target_db, start, Future(), release=False)
+      # another thread is analyzing this file; wait for it
+      return future.result(timeout=getattr(future, "wait", ANALYSIS_WAIT))
+   return _analyzeClaimed(fullpath, target_db, start, future)
+
+def _analyzeClaimed(fullpath, target_db, start, future, measured=None, release=True):
+   """Analyzes a file claimed in _loudness_pending, resolving its future and releasing the claim
+   (unless release is False, for a file claimed by a batch the caller didn't want to wait for).
+   measured is given when the file was measured already (by analyzeBatch), which only stores it."""
+   try:
+      if measured is not None:
+         if settings.config["loudness_cache"]:
+            _loudness_store.store(fullpath, measured)
+         # measured in full while a played song only estimated it
+         _loudness_estimated.pop(fullpath, None)
+      elif settings.config["loudness_cache"]:
+         measured = _loudness_store.lookup(fullpath)
+         if not _usable(measured):
+            measured = None
+      if measured is None:
+         estimate = estimateLoudness(fullpath, start)
+         if estimate is not None:
+            estimated, coverage, duration = estimate
+            print("   {} estimated from {} windows covering {:.0%} of the track.".format(
+               basename(fullpath), settings.level["windows"], coverage))
+            _loudness_estimated[fullpath] = duration
+            result = _loudnessGain(fullpath, estimated, target_db)
+            _loudness_cache[fullpath] = result
+            future.set_result(result)
+            _analysis_queue.submit(fullpath, target_db, PRIORITY_IDLE, refine=True)
+            return result
+         measured = measureLoudness(fullpath)
+         if measured is None:
+            print("   Could not analyze loudness for {}".format(fullpath))
+            result = (None, False)
+         elif settings.config["loudness_cache"]:
+            _loudness_store.store(fullpath, measured)
+      if measured is not None:
+         _loudness_measured[fullpath] = tuple(measured)
+         result = _loudnessGain(fullpath, measured, target_db)
+      _loudness_cache[fullpath] = result
+      future.set_result(result)
+      return result
+   except BaseException as e:
+      print("   Error analyzing loudness for {}: {}".format(fullpath, e))
+      future.set_exception(e)
+      raise
+   finally:
+      if release:
+         with _loudness_pending_lock:
+            del _loudness_pending[fullpath]
+
+def _estimated(fullpath):
+   # whether analyze_loudness would only estimate this file (see estimateLoudness)
+   threshold = settings.level["estimate"]
+   if threshold <= 0:
+      return False
+   duration = probeDuration(fullpath)
+   return duration is not None and duration > threshold
+
+def analyzeBatch(filepaths, target_db):
+   """Analyzes many files like analyze_loudness, measuring the ones not in the loudness store
+   with a single ffmpeg process (see VolumedetectBackend.measureBatch). Files already cached or
+   being analyzed by another thread are skipped, and files the batch couldn't measure, or that
+   are long enough to be estimated, are analyzed one at a time, so one bad file doesn't stop the
+   others. Other background workers wanting a file wait for the whole batch; songs being played
+   don't (see analyze_loudness)."""
+   claims = {}
+   with _loudness_pending_lock:
+      for filepath in filepaths:
+         fullpath = abspath(filepath)
+         if fullpath in _loudness_cache or fullpath in _loudness_pending:
+            continue
+         claims[fullpath] = Future()
+         claims[fullpath].batched = True
+         _loudness_pending[fullpath] = claims[fullpath]
+   # the batch, then every file measured on its own if it fails
+   for future in claims.values():
+      future.wait = len(claims) * (ANALYSIS_TIMEOUT + ANALYSIS_WAIT)
+   measurements = {}
+   try:
+      batch = [fullpath for fullpath in claims
+         if not (settings.config["loudness_cache"] and _usable(_loudness_store.lookup(fullpath)))
+         and not _estimated(fullpath)]
+      if len(batch) > 1:
+         print("   Measuring {} files with one ffmpeg process.".format(len(batch)))
+         measurements = backends["ffmpeg"].measureBatch(batch)
+   finally:
+      # every claim is resolved and released by _analyzeClaimed, even if the batch itself failed
+      for fullpath, future in claims.items():
+         try:
+            _analyzeClaimed(fullpath, target_db, 0, future, measurements.get(fullpath))
+         except Exception:
+            # already reported; carry on with the other files
+            pass
+
+def refineLoudness(filepath, target_db):
+   """Measures the whole of a file whose loudness was only estimated, replacing the estimate.
+   The new gain applies from the next time the song is played (or its filters are updated).
+   Each backend gets ANALYSIS_TIMEOUT for every TIMEOUT_SPAN seconds of the file. After
+   REFINE_ATTEMPTS failures the estimate is kept for good and the file is no longer estimated."""
+   fullpath = abspath(filepath)
+   with _loudness_pending_lock:
+      if fullpath not in _loudness_estimated:
+         return
+      timeout = ANALYSIS_TIMEOUT * max(1, _loudness_estimated[fullpath] / TIMEOUT_SPAN)
+      future = _loudness_pending.get(fullpath)
+      claimed = future is None
+      if claimed:
+         future = Future()
+         _loudness_pending[fullpath] = future
+   if not claimed:
+      # already being refined; wait for it
+      future.result(timeout=3*timeout)
+      return
+   measured = None
+   try:
+      measured = measureLoudness(fullpath, timeout)
+      if measured is None:
+         # keep the estimate
+         print("   Could not refine loudness for {}".format(fullpath))
+         future.set_result(_loudness_cache[fullpath])
+         return
+      if settings.config["loudness_cache"]:
+         _loudness_store.store(fullpath, measured)
+      _loudness_measured[fullpath] = tuple(measured)
+      _loudness_cache[fullpath] = _loudnessGain(fullpath, measured, target_db)
+      future.set_result(_loudness_cache[fullpath])
+   except BaseException as e:
+      print("   Error refining loudness for {}: {}".format(fullpath, e))
+      future.set_exception(e)
+      raise
+   finally:
+      with _loudness_pending_lock:
+         if measured is not None:
+            del _loudness_estimated[fullpath]
+            _refine_failures.pop(fullpath, None)
+         else:
+            _refine_failures[fullpath] = _refine_failures.get(fullpath, 0) + 1
+            if _refine_failures[fullpath] >= REFINE_ATTEMPTS:
+               print("   Keeping the estimated loudness for {}".format(fullpath))
+               del _loudness_estimated[fullpath]
+         del _loudness_pending[fullpath]
+
+def primeLoudness(measurements, target_db):
+   """Fills the cache from known measurements keyed by path, e.g. from a team bundle.
+   Files that are already cached or being analyzed are left alone, as are measurements without
+   the integrated loudness when measuring LUFS."""
+   with _loudness_pending_lock:
+      for filepath, measured in measurements.items():
+         fullpath = abspath(filepath)
+         if fullpath in _loudness_cache or fullpath in _loudness_pending or not _usable(measured):
+            continue
+         _loudness_measured[fullpath] = tuple(measured)
+         _loudness_cache[fullpath] = _loudnessGain(fullpath, measured, target_db)
+
+def loudnessMeasurements(filepaths):
+   """Returns the known measurements for the given files, keyed by absolute path."""
+   found = {}
+   for filepath in filepaths:
+      fullpath = abspath(filepath)
+      if fullpath in _loudness_measured:
+         found[fullpath] = _loudness_measured[fullpath]
+   return found
+
+# Analysis priorities, most urgent first, by how soon a song is likely to be played.
+PRIORITY_ANTHEM = 0 # anthems and the default goalhorn
+PRIORITY_FIRST = 1 # the first song of every player
+PRIORITY_CONDITIONAL = 2 # other goalhorns and victory anthems, which only play in some game states
+PRIORITY_CHANT = 3 # chants and event songs
+PRIORITY_IDLE = 4 # songs that aren't loaded yet, e.g. the tournament library
+
+class AnalysisQueue:
+   """
+      Background loudness analysis, in order of how soon each song is likely to be played.
+
+      Files are analyzed by worker threads (see analysisWorkers()), lowest priority number first
+      and in the order they were queued within a priority. Queueing a file that's already queued
+      only raises its priority. When more files are waiting than a worker measures at once (see
+      batchSize()), it takes the next ones in order and measures them in one ffmpeg process. A
+      song that's played before its turn doesn't wait for the queue at all: analyze_loudness()
+      analyzes it right away on the calling thread, and the worker skips it later. Workers run at
+      a lower priority (level:niceness) and share level:processes decoders, neither of which
+      applies to played songs (see decoderSlots()). Their priority is only lowered on Linux and,
+      on Windows, for ffmpeg processes; there the default mpv backend decodes at normal priority.
+   """
+   # seconds between checks of how many workers there should be
+   resizeInterval = 5
+
+   def __init__ (self):
+      self.threads = 0
+      self.size = 0
+      self.sized = None
+      self.lock = threading.Condition()
+      # heap of [priority, order, fullpath]; entries replaced by a higher priority are set to None
+      self.heap = []
+      # fullpath : (heap entry, target_db, start, whether to refine an estimate, list of callbacks
+      # to run once the file is analyzed)
+      self.queued = {}
+      self.order = itertools.count()
+      # files being analyzed by workers, and files finished since rigdio started
+      self.running = 0
+      self.finished = 0
+
+   def progress (self):
+      """Returns (pending, finished): files queued or being analyzed, and files analyzed so far."""
+      with self.lock:
+         return len(self.queued) + self.running, self.finished
+
+   def _resize (self):
+      # must be called with self.lock held; auto workers follow the load, so check it now and then
+      now = time.monotonic()
+      if self.sized is None or now - self.sized > AnalysisQueue.resizeInterval:
+         self.size = analysisWorkers(self.running)
+         self.sized = now
+
+   def submit (self, fullpath, target_db, priority, done = None, start = 0, refine = False):
+      with self.lock:
+         if fullpath in self.queued:
+            entry, target_db, start, refine, callbacks = self.queued[fullpath]
+            if done is not None:
+               callbacks.append(done)
+            if priority >= entry[0]:
+               return
+            entry[2] = None
+         else:
+            callbacks = [] if done is None else [done]
+         entry = [priority, next(self.order), fullpath]
+         heapq.heappush(self.heap, entry)
+         self.queued[fullpath] = (entry, target_db, start, refine, callbacks)
+         self._resize()
+         while self.threads < self.size:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads += 1
+         self.lock.notify()
+
+   def _work (self):
+      _background.worker = True
+      _lowerThreadPriority()
+      while True:
+         with self.lock:
+            self._resize()
+            # extra workers stop once the load goes up
+            if self.threads > self.size:
+               self.threads -= 1
+               return
+            while not self.heap or self.heap[0][2] is None:
+               if self.heap:
+                  heapq.heappop(self.heap)
+               else:
+                  self.lock.wait()
+            fullpath = heapq.heappop(self.heap)[2]
+            entry, target_db, start, refine, callbacks = self.queued.pop(fullpath)
+            jobs = [(fullpath, callbacks)]
+            size = batchSize()
+            if not refine and size > 1 and len(self.queued) >= size:
+               self._batch(jobs, size, target_db)
+            self.running += len(jobs)
+         try:
+            # the slot is taken before the file is claimed, see decoderSlots()
+            with decoderSlots():
+               if refine:
+                  refineLoudness(fullpath, target_db)
+               elif len(jobs) > 1:
+                  analyzeBatch([path for path, callbacks in jobs], target_db)
+               else:
+                  analyze_loudness(fullpath, target_db, start)
+         except Exception:
+            # already reported by analyze_loudness; carry on with the queue
+            pass
+         finally:
+            with self.lock:
+               self.running -= len(jobs)
+               self.finished += len(jobs)
+         for fullpath, callbacks in jobs:
+            if fullpath in _loudness_estimated and callbacks:
+               # only estimated, or the full measurement failed but can be tried again (see
+               # refineLoudness); whoever is waiting for this file waits for the full measurement
+               self.submit(fullpath, target_db, PRIORITY_IDLE, self._runner(fullpath, callbacks), refine=True)
+            else:
+               self._runner(fullpath, callbacks)()
+
+   def _batch (self, jobs, size, target_db):
+      # must be called with self.lock held; adds the next files in the queue to jobs, up to size,
+      # stopping at one that isn't measured the same way
+      while len(jobs) < size and self.heap:
+         fullpath = self.heap[0][2]
+         if fullpath is None:
+            heapq.heappop(self.heap)
+            continue
+         entry, target, start, refine, callbacks = self.queued[fullpath]
+         if refine or target != target_db:
+            return
+         heapq.heappop(self.heap)
+         del self.queued[fullpath]
+         jobs.append((fullpath, callbacks))
+
+   def _runner (self, fullpath, callbacks):
+      # returns a function running every callback, reporting errors
+      def run ():
+         for callback in callbacks:
+            try:
+               callback()
+            except Exception as e:
+               print("Error after analyzing loudness for {}: {}".format(fullpath, e))
+      return run
+
+_analysis_queue = AnalysisQueue()
+
+def analysisProgress():
+   """Returns (pending, finished) counts of background loudness analysis."""
+   return _analysis_queue.progress()
+
+def start_background_analysis(filepaths, target_db, callback=None, priorities=None, starts=None):
+   """Queue loudness analysis for all files on the background workers.
+   Non-blocking: returns immediately. Results populate _loudness_cache.
+   priorities gives each file's PRIORITY_ value (default PRIORITY_IDLE); a file listed
+   more than once is queued with its most urgent priority.
+   starts gives the offset in seconds each file is played from (default 0), where long files
+   are estimated from (see estimateLoudness).
+   callback is called with no arguments once every file has been analyzed, straight away
+   if there is nothing to analyze."""
+   if priorities is None:
+      priorities = [PRIORITY_IDLE] * len(filepaths)
+   if starts is None:
+      starts = [0] * len(filepaths)
+   urgency = {}
+   offsets = {}
+   for filepath, priority, start in zip(filepaths, priorities, starts):
+      fullpath = abspath(filepath)
+      if fullpath not in _loudness_cache and isfile(fullpath):
+         urgency[fullpath] = min(priority, urgency.get(fullpath, priority))
+         offsets.setdefault(fullpath, start)
+   if not urgency:
+      if callback is not None:
+         callback()
+      return
+   print("Queueing background loudness analysis for {} file(s)...".format(len(urgency)))
+   remaining = [len(urgency)]
+   lock = threading.Lock()
+   def done():
+      with lock:
+         remaining[0] -= 1
+         finished = remaining[0] == 0
+      if finished and callback is not None:
+         callback()
+   for fullpath, priority in urgency.items():
+      _analysis_queue.submit(fullpath, target_db, priority, done, offsets[fullpath])
@@ -1,6 +1,7 @@
 import sys
+import argparse
 import threading
-from os.path import isfile, join, abspath, splitext
+from os.path import isfile, isdir, join, abspath, splitext
 
 from tkinter import *
 import tkinter.filedialog as filedialog
@@ -10,6 +11,7 @@ from config import genConfig, openConfig, applyDarkMode, settings
 
 from condition import MatchCondition
 from rigparse import parse as parseLegacy
+from loudness import analysisProgress
 from gamestate import GameState
 from songgui import *
 from version import rigdio_version as version
@@ -18,6 +20,7 @@ from rigdio_util import volumeColor, sliderToDb
 from event import EventController
 import chantswindow as cWin
 import legacy
+from library import TeamLibrary
 
 from logger import startLog
 if __name__ == '__main__':
@@ -68,10 +71,20 @@ class Rigdio (Frame):
       # file menu
       homeButtons = Frame(self)
       Button(homeButtons, text="Load Home Team", command=self.loadFile, bg=self.colours["home"]).pack(fill=X)
-      Button(homeButtons, text="Reset", command=self.resetTeam, bg=self.colours["reset"]).pack()
-      homeButtons.grid(row=0, column=0)
       awayButtons = Frame(self)
       Button(awayButtons, text="Load Away Team", command=lambda: self.loadFile(False), bg=self.colours["away"]).pack(fill=X)
+      # tournament library, prepared in the background
+      self.library = None
+      if settings.config["tournament_library"]:
+         if isdir(settings.config["tournament_library"]):
+            self.library = TeamLibrary(settings.config["tournament_library"])
+            self.library.start()
+            Button(homeButtons, text="Home From Library", command=self.openLibrary, bg=self.colours["home"]).pack(fill=X)
+            Button(awayButtons, text="Away From Library", command=lambda: self.openLibrary(False), bg=self.colours["away"]).pack(fill=X)
+         else:
+            print("Tournament library folder {} not found.".format(settings.config["tournament_library"]))
+      Button(homeButtons, text="Reset", command=self.resetTeam, bg=self.colours["reset"]).pack()
+      homeButtons.grid(row=0, column=0)
       Button(awayButtons, text="Reset", command=lambda: self.resetTeam(False), bg=self.colours["reset"]).pack()
       awayButtons.grid(row=0, column=2)
       # score widget
@@ -83,8 +96,9 @@ class Rigdio (Frame):
       # other stuff for the middle column, like playback speed slider and chants
       self.middleStuff = Frame(self)
       self.initMiddleStuff().grid(row=2,column=1)
-      # used for the chaoshorn
+      # used for the chaoshorn; mixer is set while it's played on a single mpv core (chaoshorn_mixer)
       self.nuke = False
+      self.mixer = None
       # events
       self.events = EventController()
       # blank space
@@ -106,6 +120,28 @@ class Rigdio (Frame):
 
    def changeGameType (self, option):
       self.game.gametype = option.lower()
+      self.foldConditions()
+
+   # resolves the conditions that can't change during a match, after a team is loaded or the match type changes
+   def foldConditions (self):
+      for team in (self.home, self.away):
+         if team is not None:
+            team.foldConditions(self.game)
+
+   def prepareSongs (self):
+      """
+         Gets the loaded teams' songs ready to play ahead of time, as long as the mpv pool has room:
+         both anthems first, as they're the first songs of a match, then the goalhorns. While only
+         one team is loaded, a core is kept free for the other team's anthem.
+      """
+      room = legacy._mpv_pool.room()
+      teams = [team for team in (self.home, self.away) if team is not None]
+      for team in teams:
+         if room > 0 and team.anthemButton.clists.prepare():
+            room -= 1
+      room -= 2 - len(teams)
+      for team in teams:
+         room = team.prepare(room)
 
    def initMiddleStuff (self):
       # chaos horn
@@ -158,19 +194,41 @@ class Rigdio (Frame):
       """Chaoshorn will play all the player buttons (including the Anthem and VA) that are currently loaded at the same time. Do you still want to go the nuclear option?""", icon='warning')
       if not confirm or self.nuke:
          return
+      teams = [team for team in (self.home, self.away) if team is not None]
+      self.nuke = True
+      if settings.config["chaoshorn_mixer"]:
+         # songs that haven't been analyzed yet are analyzed off the Tk thread before the mix starts;
+         # stopNuclear() in the meantime drops the mixer, so playMixer() does nothing
+         self.mixer = legacy.ChaosMixer([song for team in teams for song in team.chaosSongs()])
+         mixer = self.mixer
+         mixer.prime(lambda: self.after(0, lambda: self.playMixer(mixer, teams)))
       else:
-         if self.home is not None:
-            self.home.goNuclear()
-         if self.away is not None:
-            self.away.goNuclear()
-         self.nuke = True
+         for team in teams:
+            team.goNuclear()
+
+   def playMixer(self, mixer, teams):
+      if self.mixer is not mixer:
+         return
+      try:
+         mixer.play(self.playbackSpeedMenu.get())
+         for team in teams:
+            team.chaosScore()
+      except Exception as e:
+         print("Could not mix chaoshorn on one mpv core, playing every song on its own: {}".format(e))
+         self.mixer = None
+         for team in teams:
+            team.goNuclear()
 
    def stopNuclear(self):
       if self.nuke:
-         if self.home is not None:
-            self.home.stopNuclear()
-         if self.away is not None:
-            self.away.stopNuclear()
+         if self.mixer is not None:
+            self.mixer.stop()
+            self.mixer = None
+         else:
+            if self.home is not None:
+               self.home.stopNuclear()
+            if self.away is not None:
+               self.away.stopNuclear()
          self.nuke = False
 
    def _playbackSpeedCommand (self, value):
@@ -238,17 +296,29 @@ class Rigdio (Frame):
       self.stopNuclear()
       # kill any possible ongoing other threads first before closing
       self.chantsManager.endThread()
-      legacy.titleCheck = False
+      # stop fades, end of song handling, chant timeouts and the title log before their cores go away
+      legacy.dispatcher.close()
+      # drop the songs still waiting to be pre-rolled
+      legacy._preparer.shutdown(wait=False, cancel_futures=True)
+      # close every mpv core so no audio outlives the window
+      legacy._mpv_pool.close()
       master.destroy()
 
-   def legacyLoad (self, f, home):
-      print("Loading music instructions from {}.".format(f))
+   def legacyLoad (self, jobs):
+      """
+         Loads one or more team exports, given as (filename, home) pairs, on worker threads.
+
+         Both teams can be loaded at once (e.g. from the command line); they share one progress
+         window and are added to the main window in order once all of them are done.
+      """
+      for f, home in jobs:
+         print("Loading music instructions from {}.".format(f))
       # create a loading progress window
       loadWin = Toplevel(self)
       loadWin.title("Loading")
       loadWin.resizable(False, False)
       loadWin.transient(self)
-      loadLabel = Label(loadWin, text="Loading team export...", padx=20, pady=10)
+      loadLabel = Label(loadWin, text="Loading team export{}...".format("s" if len(jobs) > 1 else ""), padx=20, pady=10)
       loadLabel.pack()
       barWidth = 300
       barHeight = 20
@@ -256,61 +326,83 @@ class Rigdio (Frame):
       loadBar.pack(padx=20, pady=5)
       loadStatus = Label(loadWin, text="", padx=20, pady=10)
       loadStatus.pack()
+      # background loudness analysis counter, counted from when this window opened
+      analysisStatus = Label(loadWin, text="", padx=20)
+      if settings.config["normalize_volume"]:
+         analysisStatus.pack(pady=(0, 10))
+      finishedBefore = analysisProgress()[1]
       # grab focus so user can't interact with main window
       loadWin.grab_set()
       loadWin.update()
 
-      # shared state between threads
-      state = {"result": None, "error": None, "done": False,
-               "phase": 0, "completed": 0, "total": 0, "songs_loaded": 0, "songs_total": 0}
+      # shared state between threads; each job reports progress from its own thread
+      lock = threading.Lock()
+      state = {"results": [None] * len(jobs), "errors": [None] * len(jobs), "done": 0,
+               "phase": 0, "songs_loaded": 0, "songs_total": 0}
 
       def progress_callback(completed, total):
-         if completed == -2:
-            # set song count from pre-pass
-            state["songs_total"] = total
-         elif completed == -1:
-            # a song was loaded
-            state["phase"] = 2
-            state["songs_loaded"] += 1
-
-      def worker():
+         with lock:
+            if completed == -2:
+               # add song count once a team's files are found
+               state["songs_total"] += total
+            elif completed == -1:
+               # a song was loaded
+               state["phase"] = 2
+               state["songs_loaded"] += 1
+
+      def worker(i, f, home):
          try:
-            result = parseLegacy(f, home=home, progress_callback=progress_callback)
-            state["result"] = result
+            # teams prepared by the tournament library skip reading the file
+            team = self.library.team(f) if self.library is not None else None
+            state["results"][i] = parseLegacy(f, home=home, progress_callback=progress_callback, team=team)
          except Exception as e:
-            state["error"] = e
-         state["done"] = True
+            state["errors"][i] = e
+         with lock:
+            state["done"] += 1
 
-      thread = threading.Thread(target=worker, daemon=True)
-      thread.start()
+      for i, (f, home) in enumerate(jobs):
+         thread = threading.Thread(target=worker, args=(i, f, home), daemon=True)
+         thread.start()
 
       def poll():
-         if state["done"]:
+         if state["done"] == len(jobs):
             loadWin.grab_release()
             loadWin.destroy()
-            if state["error"] is not None:
-               e = state["error"]
+            error = None
+            for (f, home), result, e in zip(jobs, state["results"], state["errors"]):
+               if e is None:
+                  try:
+                     self._finishLegacyLoad(f, home, result)
+                  except Exception as e:
+                     error = error or e
+                  continue
                if isinstance(e, AttributeError):
                   messagebox.showerror("AttributeError on file load.","Did you download rigdio.exe instead of rigdio.7z? Make sure that the mpv DLL is present.")
                elif isinstance(e, UnicodeDecodeError):
                   messagebox.showerror("UnicodeDecodeError on file load.","Are any of your file names using weeb/non-unicode characters? Make sure they are using only unicode characters.")
                else:
                   messagebox.showerror("Exception on file load.", e)
-               raise e
-            self._finishLegacyLoad(f, home, state["result"])
+               error = error or e
+            if error is not None:
+               raise error
             return
          # update progress UI
          loadBar.delete("all")
-         if state["phase"] == 2:
-            if state["songs_total"] > 0:
-               greenW = int(barWidth * state["songs_loaded"] / state["songs_total"])
+         with lock:
+            phase, loaded, total = state["phase"], state["songs_loaded"], state["songs_total"]
+         if phase == 2:
+            if total > 0:
+               greenW = int(barWidth * min(loaded, total) / total)
                loadBar.create_rectangle(0, 0, greenW, barHeight, fill='#22aa22', outline='')
-               loadStatus["text"] = "Loading songs... {}/{}".format(state["songs_loaded"], state["songs_total"])
+               loadStatus["text"] = "Loading songs... {}/{}".format(loaded, total)
             else:
-               loadStatus["text"] = "Loading songs... {}".format(state["songs_loaded"])
-         elif state["phase"] == 0 and state["songs_total"] > 0:
-            # pre-pass done, no analysis phase (normalize off) — show empty bar ready for green
-            loadStatus["text"] = "Loading songs... 0/{}".format(state["songs_total"])
+               loadStatus["text"] = "Loading songs... {}".format(loaded)
+         elif phase == 0 and total > 0:
+            # files found, no songs loaded yet — show empty bar ready for green
+            loadStatus["text"] = "Loading songs... 0/{}".format(total)
+         if settings.config["normalize_volume"]:
+            pending, finished = analysisProgress()
+            analysisStatus["text"] = "Loudness analysis: {} pending, {} finished".format(pending, finished - finishedBefore)
          self.after(50, poll)
 
       self.after(50, poll)
@@ -394,6 +486,9 @@ class Rigdio (Frame):
       self.scoreWidget.updateLabels()
       self.game.clear()
       self.scoreWidget.updateScore()
+      # the opponent changed for both teams
+      self.foldConditions()
+      self.prepareSongs()
 
    def resetTeam (self, home = True):
       team = self.home if home else self.away
@@ -430,6 +525,43 @@ class Rigdio (Frame):
       self.scoreWidget.updateScore()
       print("{} team reset.".format("Home" if home else "Away"))
 
+   def openLibrary (self, home = True):
+      """Opens a window listing the tournament library's teams, loading the one picked."""
+      pickWin = Toplevel(self)
+      pickWin.title("{} Team From Library".format("Home" if home else "Away"))
+      pickWin.transient(self)
+      exports = self.library.exports
+      teamList = Listbox(pickWin, width=60, height=min(max(len(exports), 1), 32))
+      teamList.pack(padx=10, pady=10, fill=BOTH, expand=True)
+
+      for f in exports:
+         teamList.insert(END, self.library.describe(f))
+
+      def refresh():
+         if not pickWin.winfo_exists():
+            return
+         # keep showing teams as they finish preparing
+         for i, f in enumerate(exports):
+            text = self.library.describe(f)
+            if teamList.get(i) != text:
+               selected = teamList.selection_includes(i)
+               teamList.delete(i)
+               teamList.insert(i, text)
+               if selected:
+                  teamList.selection_set(i)
+         pickWin.after(500, refresh)
+
+      def pick(event = None):
+         selection = teamList.curselection()
+         if not selection:
+            return
+         pickWin.destroy()
+         self.legacyLoad([(exports[selection[0]], home)])
+
+      teamList.bind("<Double-Button-1>", pick)
+      Button(pickWin, text="Load", command=pick, bg=self.colours["home" if home else "away"]).pack(pady=(0, 10))
+      pickWin.after(500, refresh)
+
    def loadFile (self, home = True):
       f = filedialog.askopenfilename(filetypes = (("Rigdio export files", "*.4ccm"),("All files","*.*")))
       if f == "":
@@ -438,7 +570,7 @@ class Rigdio (Frame):
       elif isfile(f):
          extension = splitext(f)[1]
          if extension == ".4ccm":
-            self.legacyLoad(f,home)
+            self.legacyLoad([(f,home)])
          else:
             messagebox.showerror("Error","File type {} not supported.".format(extension))
             return
@@ -454,7 +586,7 @@ def resource_path(relative_path):
       base_path = abspath(".")
    return join(base_path, relative_path)
 
-def main ():
+def main (home = None, away = None):
    master = Tk()
    try:
       datafile = resource_path("rigdio.ico")
@@ -472,6 +604,17 @@ def main ():
    # if config file was generated, show config prompt window before letting Rigdio run
    if settings.fileGen:
       openConfig()
+   # team exports given on the command line are loaded together
+   jobs = []
+   for f, isHome in ((home, True), (away, False)):
+      if f is None:
+         continue
+      if isfile(f):
+         jobs.append((abspath(f).replace("\\", "/"), isHome))
+      else:
+         messagebox.showerror("Error","File {} not found.".format(f))
+   if jobs:
+      master.after(0, lambda: rigdio.legacyLoad(jobs))
    try:
       mainloop()
    except RuntimeError as e:
@@ -481,8 +624,17 @@ def main ():
       return
 
 if __name__ == '__main__':
-   if len(sys.argv) > 1 and sys.argv[1] == "genconfig":
+   parser = argparse.ArgumentParser(description="rigdio {}".format(version))
+   parser.add_argument("command", nargs="?", help="genconfig to generate config.yml and exit, or a .4ccm export to load for the home team (e.g. a file dropped on rigdio)")
+   parser.add_argument("--home", metavar="FILE", help=".4ccm export to load for the home team")
+   parser.add_argument("--away", metavar="FILE", help=".4ccm export to load for the away team")
+   # anything else on the command line is ignored, as it always was
+   args, ignored = parser.parse_known_args()
+   if args.command == "genconfig":
       print("Generating config file rigdio.yml")
       genConfig()
    else:
-      main()
+      home = args.home
+      if home is None and args.command is not None and isfile(args.command):
+         home = args.command
+      main(home, args.away)
@@ -13,4 +13,30 @@ class SongNotFound (Exception):
       self.pname = pname
 
    def __str__ (self):
-      return "No song was found matching current game state for player {}. No music will play.".format(self.pname)
\ No newline at end of file
+      return "No song was found matching current game state for player {}. No music will play.".format(self.pname)
+
+class LoudnessError (Exception):
+   def __init__ (self, filename, reason):
+      self.filename = filename
+      self.reason = reason
+
+   def __str__ (self):
+      return "Could not measure loudness of {}: {}".format(self.filename, self.reason)
+
+class TokenError (ValueError):
+   def __init__ (self, position, reason):
+      self.position = position
+      self.reason = reason
+
+   def __str__ (self):
+      return "{} at column {}".format(self.reason, self.position+1)
+
+class ParseError (Exception):
+   def __init__ (self, filename, line, column, reason):
+      self.filename = filename
+      self.line = line
+      self.column = column
+      self.reason = reason
+
+   def __str__ (self):
+      return "{} (line {}, column {}): {}".format(self.filename, self.line, self.column, self.reason)
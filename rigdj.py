@@ -15,6 +15,7 @@ from conditioneditor import ConditionDialog
 
 from rigdj_util import *
 from rigparse import parse, reserved
+from rigdio_except import ParseError
 
 from logger import startLog
 if __name__ == '__main__':
@@ -796,7 +797,11 @@ class Editor (Frame):
 
    def load4ccm (self):
       self.filename = filedialog.askopenfilename(filetypes = (("Rigdio export files", "*.4ccm"),("All files","*")))
-      songs, teamName, events = parse(self.filename,False)
+      try:
+         songs, teamName, events = parse(self.filename,False)
+      except ParseError as e:
+         messagebox.showerror("Error", str(e))
+         return
       uiConvert(songs)
 
       self.teamEntry.delete(0,END)
@@ -1,110 +1,252 @@
-from os import listdir
+from os import scandir, sep
 from os.path import basename, splitext, isfile
-from legacy import ConditionList, ConditionPlayer, start_background_analysis
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import threading
+from legacy import ConditionList, ConditionPlayer, _mpv_pool
+from loudness import start_background_analysis, primeLoudness, loudnessMeasurements
+from loudness import PRIORITY_ANTHEM, PRIORITY_FIRST, PRIORITY_CONDITIONAL, PRIORITY_CHANT
+from condition import tokenize, buildCondition, Token
+from bundle import compileBundle, readBundle, writeBundle, isCurrent, bundleSongs
+from rigdio_except import ParseError, TokenError
 from config import settings
+from rigdio_util import timeToSeconds
 
 # reserved names
 reserved = set(['anthem', 'victory', 'goal', 'name', 'chant', ';event', 'sync'])
+# most songs looked up and loaded at once when loading a team
+LOAD_WORKERS = 8
+# idle mpv cores opened while loading a team, for the anthem and first goalhorn
+WARM_CORES = 2
+# names used in the default file names of reserved entries
+fancynames = {
+   "goal" : "Goalhorn",
+   "anthem" : "Anthem",
+   "victory" : "Victory Anthem",
+   "chant" : "Chant"
+}
 
-def parse (filename, load = True, home = True, progress_callback=None):
-   """Parses a music export file and loads it into memory."""
+class Node:
+   """Part of a .4ccm file. Line and column are where it starts in the file, counting from 1."""
+   def __init__ (self, line, column = 1):
+      self.line = line
+      self.column = column
+
+class TeamHeader (Node):
+   """The name;<team> line. If a file has none, the team is named after the file and line is 0."""
+   def __init__ (self, tname, line = 0, column = 1):
+      Node.__init__(self, line, column)
+      self.tname = tname
+
+class SyncFlag (Node):
+   """The sync;<yes/no> line, which can only come right after the team name."""
+   def __init__ (self, enabled, line, column = 1):
+      Node.__init__(self, line, column)
+      self.enabled = enabled
+
+class Clause (Node):
+   """A condition or instruction of a song entry, already split into tokens."""
+   def __init__ (self, text, tokens, line, column):
+      Node.__init__(self, line, column)
+      self.text = text
+      self.tokens = [token.text for token in tokens]
+      # column of each token
+      self.columns = [column + token.start for token in tokens]
+
+   def toData (self):
+      return {"text" : self.text, "column" : self.column, "tokens" : self.tokens, "columns" : self.columns}
+
+class SongEntry (Node):
+   """A player;file;clauses... line. defaulted is True if the file name was left out."""
+   def __init__ (self, player, filename, clauses, line, column, defaulted = False):
+      Node.__init__(self, line, column)
+      self.player = player
+      self.filename = filename
+      self.clauses = clauses
+      self.defaulted = defaulted
+
+   def tokens (self):
+      return [clause.tokens for clause in self.clauses]
+
+   def toData (self):
+      return {
+         "player" : self.player,
+         "filename" : self.filename,
+         "clauses" : [clause.toData() for clause in self.clauses],
+         "line" : self.line,
+         "column" : self.column,
+         "defaulted" : self.defaulted
+      }
+
+def entryFromData (data):
+   """Rebuilds a SongEntry saved with SongEntry.toData(), e.g. in a compiled team bundle."""
+   clauses = []
+   for clause in data["clauses"]:
+      tokens = [Token(text, column - clause["column"]) for text, column in zip(clause["tokens"], clause["columns"])]
+      clauses.append(Clause(clause["text"], tokens, data["line"], clause["column"]))
+   return SongEntry(data["player"], data["filename"], clauses, data["line"], data["column"], data["defaulted"])
+
+def readExport (filename):
+   """
+      Reads a music export file one line at a time, yielding its TeamHeader first, then a SyncFlag
+      if it has one, then a SongEntry for every song.
+
+      Raises ParseError with the position of a line that can't be read.
+   """
+   header = None
+   # the sync flag is only recognised on the line right after the team name
+   syncLine = None
+   with open(filename) as f:
+      for number, raw in enumerate(f, 1):
+         line = raw.strip()
+         indent = len(raw) - len(raw.lstrip())
+         if header is None:
+            # the team name is on the first line that isn't blank or a comment
+            if len(line) == 0 or line[0] == '#':
+               continue
+            nameline = line.split(';')
+            if len(nameline) < 2 or nameline[0] != "name":
+               print("No team name provided at start of file; defaulting to filename")
+               header = TeamHeader(splitext(basename(filename))[0])
+               yield header
+               # this line is still read as a sync flag or an entry
+               syncLine = number
+            else:
+               header = TeamHeader(nameline[1].lower(), number, indent+1)
+               yield header
+               syncLine = number+1
+               continue
+         if number == syncLine and line.split(';')[0].strip().lower() == "sync":
+            fields = line.split(';')
+            if len(fields) < 2:
+               raise ParseError(filename, number, indent+1, "sync flag has no value")
+            sync = fields[1].strip().lower() not in ("no", "off", "false", "0")
+            print("Sync flag: {}".format("enabled" if sync else "disabled"))
+            yield SyncFlag(sync, number, indent+1)
+            continue
+         # ignore comments
+         if len(line) == 0 or line[0] == "#":
+            continue
+         yield readEntry(filename, header.tname, line, number, indent+1)
+   if header is None:
+      # nothing but comments
+      print("No team name provided at start of file; defaulting to filename")
+      yield TeamHeader(splitext(basename(filename))[0])
+
+def readEntry (filename, tname, line, number, column):
+   # split up line by ; and trim whitespace from ends of strings, keeping where each field starts
+   fields = []
+   for text in line.split(';'):
+      fields.append((text.strip(), column + len(text) - len(text.lstrip())))
+      column += len(text) + 1
+   player = fields[0][0] # name of player
+   defaulted = len(fields) == 1
+   if defaulted:
+      default = "{} - {}.mp3" if player in reserved else "{} - {} Goalhorn.mp3"
+      fancyname = fancynames[player] if player in reserved else player
+      default = default.format(tname,fancyname)
+      print("No file name specified for {}, looking for {}.".format(player, default))
+      fields.append((default, fields[0][1]))
+   clauses = []
+   for text, start in fields[2:]:
+      try:
+         tokens = tokenize(text)
+      except TokenError as e:
+         raise ParseError(filename, number, start + e.position, "{} in {}".format(e.reason, text))
+      clauses.append(Clause(text, tokens, number, start))
+   return SongEntry(player, fields[1][0], clauses, number, fields[0][1], defaulted)
+
+def readEntries (filename):
+   """Reads a music export file, returning its team name, sync flag and song entries."""
+   nodes = readExport(filename)
+   tname = next(nodes).tname
+   # sync flag defaults to yes
+   sync = True
+   entries = []
+   for node in nodes:
+      if isinstance(node, SyncFlag):
+         sync = node.enabled
+      else:
+         entries.append(node)
+   return tname, sync, entries
+
+def readTeam (filename):
+   """
+      Reads a music export file and looks up its songs, returning it compiled (see
+      bundle.compileBundle()) along with whether it came from a saved bundle.
+   """
+   normalize = settings.config["normalize_volume"]
+   # a compiled bundle from an earlier load skips reading the file and looking up songs
+   if settings.config["team_bundles"]:
+      compiled = readBundle(filename, normalize)
+      if compiled is not None:
+         print("Using compiled team bundle for {}".format(filename))
+         return compiled, True
+   folder = '/'.join(filename.split('/')[0:-1])+'/'
+   tname, sync, entries = readEntries(filename)
+   # list the folder once for every song lookup
+   songs = findSongs(folder, entries, FolderIndex(folder))
+   return compileBundle(filename, normalize, tname, sync, [entry.toData() for entry in entries], songs, {}), False
+
+def validateTeam (filename, team):
+   """Builds the conditions of every entry in a compiled team, raising ParseError for the first invalid one."""
+   for data in team["entries"]:
+      entry = entryFromData(data)
+      with entryErrors(filename, entry, team["tname"]):
+         ConditionList(pname=entry.player, tname=team["tname"], data=entry.tokens(), songname=entry.filename, runInstructions=False)
+
+def parse (filename, load = True, home = True, progress_callback=None, team=None):
+   """
+      Parses a music export file and loads it into memory.
+
+      team may be the file already compiled by readTeam() (e.g. by the tournament library), which
+      is used instead of reading the file again as long as none of its files changed.
+   """
    # get location of folder
    folder = '/'.join(filename.split('/')[0:-1])+'/'
    # regular player clist collections
    players = {}
    # event
    events = {}
-   filenames = {
-      "goal" : "Goalhorn",
-      "anthem" : "Anthem",
-      "victory" : "Victory Anthem",
-      "chant" : "Chant"
-   }
-
-   # open filename
-   with open(filename) as f:
-      lines = [line.strip() for line in f.readlines()]
-      f.close()
-
-   # get name
-   while len(lines[0]) == 0 or lines[0][0] == '#':
-      lines = lines[1:]
-   nameline = lines[0].split(';')
-   if len(nameline) < 2 or nameline[0] != "name":
-      print("No team name provided at start of file; defaulting to filename")
-      tname = splitext(basename(filename))[0]
-   else:
-      tname = nameline[1].lower()
-      lines = lines[1:]
 
-   # check for sync flag (defaults to yes)
-   sync = True
-   if lines and lines[0].split(';')[0].strip().lower() == "sync":
-      syncval = lines[0].split(';')[1].strip().lower()
-      sync = syncval not in ("no", "off", "false", "0")
-      print("Sync flag: {}".format("enabled" if sync else "disabled"))
-      lines = lines[1:]
-
-   # iterate across lines
-   # pre-pass: collect song count for progress UI
+   # if we're loading the songs, create ConditionPlayer objects
    if load:
-      pre_files = []
-      for line in lines:
-         if len(line) == 0 or line[0] == "#":
-            continue
-         data = line.split(';')
-         data = [x.strip() for x in data]
-         player = data[0]
-         if len(data) == 1:
-            default = "{} - {}.mp3" if player in reserved else "{} - {} Goalhorn.mp3"
-            fancyname = filenames[player] if player in reserved else player
-            default = default.format(tname, fancyname)
-            data.append(default)
-         pre_files.append(songCheck(folder, data[1]))
-      song_count = len(pre_files)
+      saved = team is not None and isCurrent(team, filename, settings.config["normalize_volume"])
+      if not saved:
+         team, saved = readTeam(filename)
+      tname = team["tname"]
+      sync = team["sync"]
+      entries = [entryFromData(data) for data in team["entries"]]
+      songs = bundleSongs(team)
       if progress_callback:
-         progress_callback(-2, song_count)
+         progress_callback(-2, len(songs))
+      # the bundle is saved once the team has loaded, and again when loudness analysis finishes
+      loaded = threading.Event()
+      def analysed ():
+         if loaded.is_set():
+            saveBundle(filename, team)
       if settings.config["normalize_volume"]:
-         start_background_analysis(pre_files, settings.level["target"])
-   # main pass: create ConditionPlayer objects
-   for line in lines:
-      # ignore comments
-      if len(line) == 0 or line[0] == "#":
-         continue
-      # split up line by ;
-      data = line.split(';')
-      # trim whitespace from ends of strings
-      data = [x.strip() for x in data]
-      player = data[0] # name of player
-      if len(data) == 1:
-         default = "{} - {}.mp3" if player in reserved else "{} - {} Goalhorn.mp3"
-         fancyname = filenames[player] if player in reserved else player
-         default = default.format(tname,fancyname)
-         print("No file name specified for {}, looking for {}.".format(player, default))
-         data.append(default)
-      filename = folder+data[1] # location of song, relative to location of export file
-      # if we're loading the songs, create ConditionPlayer objects
+         primeLoudness(team["loudness"], settings.level["target"])
+         start_background_analysis(songs, settings.level["target"], analysed, analysisPriorities(entries), analysisStarts(entries))
+      clists = loadPlayers(filename, entries, songs, tname, home, sync, progress_callback)
+      loaded.set()
+      if not saved:
+         saveBundle(filename, team)
+   else:
+      tname, sync, entries = readEntries(filename)
+   for i, entry in enumerate(entries):
+      player = entry.player
       if load:
-         filename = songCheck(folder, data[1]) # check for song file, including normalised
-         songtype = player if player in ("anthem", "victory", "chant") else "goalhorn"
-         clist = ConditionPlayer(
-            pname=data[0],
-            tname=tname,
-            data=data[2:],
-            songname=filename,
-            home=home,
-            type=songtype,
-            sync=sync)
-         if progress_callback:
-            progress_callback(-1, -1)
+         clist = clists[i]
       # otherwise, ConditionList uses less memory and doesn't make mpv calls
       else:
-         clist = ConditionList(
-            pname=data[0],
-            tname=tname,
-            data=data[2:],
-            songname=filename,
-            home=home)
+         with entryErrors(filename, entry, tname):
+            clist = ConditionList(
+               pname=player,
+               tname=tname,
+               data=entry.tokens(),
+               songname=folder+entry.filename, # location of song, relative to location of export file
+               home=home)
          # when rigdj loads a .4ccm where a condition's value has spaces (special, mostgoals),
          # it will remove the accompanying square brackets, and unless the user corrects it
          # before saving, it breaks the condition's value
@@ -140,28 +282,170 @@ def parse (filename, load = True, home = True, progress_callback=None):
    print("Loaded songs for team /{}/".format(tname))
    return players, tname, events
 
-def songCheck (folder, name):
+def analysisPriorities (entries):
+   """Returns the loudness analysis priority of every entry, by how soon its song is likely to play."""
+   priorities = []
+   seen = set()
+   for entry in entries:
+      if entry.player in ("anthem", "goal"):
+         priority = PRIORITY_ANTHEM
+      elif entry.player == "chant" or any(clause.tokens[:1] == ["event"] for clause in entry.clauses):
+         priority = PRIORITY_CHANT
+      elif entry.player not in seen:
+         # the first song listed for a player plays unless its conditions fail
+         priority = PRIORITY_FIRST
+      else:
+         priority = PRIORITY_CONDITIONAL
+      seen.add(entry.player)
+      priorities.append(priority)
+   return priorities
+
+def analysisStarts (entries):
+   """Returns where every entry's song starts playing in seconds, from its start instruction."""
+   starts = []
+   for entry in entries:
+      start = 0
+      for clause in entry.clauses:
+         if len(clause.tokens) > 1 and clause.tokens[0].lower() == "start":
+            start = timeToSeconds(clause.tokens[1]) or 0
+      starts.append(start)
+   return starts
+
+def findSongs (folder, entries, index):
+   """Returns the song file of every entry, looked up on a pool of threads."""
+   with ThreadPoolExecutor(max_workers=max(1, min(LOAD_WORKERS, len(entries)))) as pool:
+      return list(pool.map(lambda entry: songCheck(folder, entry.filename, index), entries))
+
+def loadPlayers (filename, entries, songs, tname, home, sync, progress_callback=None):
+   """
+      Creates a ConditionPlayer for every song entry, in the same order as the entries.
+
+      Players are created on a pool of threads, and a few mpv cores are opened in the background
+      so the first song played doesn't wait for mpv to start. Progress is reported as (-1, -1) from
+      the calling thread for each player created.
+   """
+   workers = max(1, min(LOAD_WORKERS, len(entries)))
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      futures = [pool.submit(loadPlayer, filename, entry, song, tname, home, sync) for entry, song in zip(entries, songs)]
+      for i in range(WARM_CORES):
+         pool.submit(_mpv_pool.warm)
+      for future in as_completed(futures):
+         try:
+            future.result()
+         except Exception:
+            # raise the first error (e.g. an invalid condition) without loading the songs that
+            # haven't started yet; only the ones already loading are waited for
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+         if progress_callback:
+            progress_callback(-1, -1)
+   return [future.result() for future in futures]
+
+def saveBundle (filename, team):
+   songs = bundleSongs(team)
+   # teams with missing songs fail to load anyway
+   if not settings.config["team_bundles"] or not all(isfile(song) for song in songs):
+      return
+   if settings.config["normalize_volume"]:
+      team["loudness"] = loudnessMeasurements(songs)
+   writeBundle(filename, team)
+
+def loadPlayer (filename, entry, song, tname, home, sync):
+   player = entry.player
+   songtype = player if player in ("anthem", "victory", "chant") else "goalhorn"
+   with entryErrors(filename, entry, tname):
+      return ConditionPlayer(
+         pname=player,
+         tname=tname,
+         data=entry.tokens(),
+         songname=song,
+         home=home,
+         type=songtype,
+         sync=sync)
+
+@contextmanager
+def entryErrors (filename, entry, tname):
+   # invalid conditions raise ValueError; report them with where the invalid clause is in the file,
+   # or where the entry is if it can't be told
+   try:
+      yield
+   except ValueError as e:
+      clause = invalidClause(entry, tname)
+      if clause is None:
+         raise ParseError(filename, entry.line, entry.column, e) from e
+      raise ParseError(filename, clause.line, clause.columns[0], "{} in {}".format(str(e).rstrip("."), clause.text)) from e
+
+def invalidClause (entry, tname):
+   """Returns the first clause of an entry that isn't a valid condition or instruction, or None."""
+   for clause in entry.clauses:
+      if not clause.tokens:
+         continue
+      try:
+         buildCondition(clause.tokens, pname=entry.player, tname=tname, home=True)
+      except ValueError:
+         return clause
+   return None
+
+class FolderIndex:
+   """
+      Listing of a song folder, read once, for case-insensitive file lookups.
+
+      Parsing an export makes a single index of its folder instead of listing the folder again for
+      every song.
+   """
+   def __init__ (self, folder):
+      self.folder = folder
+      # file names as they are on disk
+      self.files = set()
+      # lowercase file name : file name
+      self.names = {}
+      # lowercase file name without extension : file name
+      self.stems = {}
+      try:
+         with scandir(folder) as entries:
+            for entry in entries:
+               if not entry.is_file():
+                  continue
+               self.files.add(entry.name)
+               self.names.setdefault(entry.name.lower(), entry.name)
+               self.stems.setdefault(splitext(entry.name)[0].lower(), entry.name)
+      except OSError as e:
+         print("Could not list folder {}: {}".format(folder, e))
+
+   def find (self, name):
+      """Returns the name of the file called name, ignoring case, or None if there isn't one."""
+      if name in self.files:
+         return name
+      # names in subfolders aren't indexed
+      if "/" in name or sep in name:
+         return name if isfile(self.folder+name) else None
+      return self.names.get(name.lower())
+
+   def findStem (self, stem):
+      """Returns the name of a file called stem with any extension, ignoring case, or None."""
+      return self.stems.get(stem.lower())
+
+def songCheck (folder, name, index = None):
+   if index is None:
+      index = FolderIndex(folder)
    normalized = splitext(name)[0] + "_normalized"
    if not settings.config["normalize_volume"]:
       # when normalize_volume is disabled, prefer _normalized files if they exist
-      for file in listdir(folder):
-         if splitext(file)[0].lower() == normalized.lower():
-            print("Normalized version of " + folder+name + " found")
-            return folder+file
+      file = index.findStem(normalized)
+      if file is not None:
+         print("Normalized version of " + folder+name + " found")
+         return folder+file
    # check for regular song file
    # required due to linux's file system being case-sensitive
-   if not isfile(folder+name):
-      for file in listdir(folder):
-         if file.lower() == name.lower():
-            return folder+file
-   else:
-      return folder+name
+   file = index.find(name)
+   if file is not None:
+      return folder+file
    # no regular file found; fall back to _normalized version if it exists
    # (will be renormalized at playback to the configured target level)
-   for file in listdir(folder):
-      if splitext(file)[0].lower() == normalized.lower():
-         print("Regular file not found, using normalized version of " + folder+name)
-         return folder+file
+   file = index.findStem(normalized)
+   if file is not None:
+      print("Regular file not found, using normalized version of " + folder+name)
+      return folder+file
    return folder+name
 
 def main ():
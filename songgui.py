@@ -6,7 +6,7 @@ from rigdio_except import UnloadSong, SongNotFound
 from legacy import PlayerManager
 from config import settings
 from rigdio_util import volumeColor
-from time import sleep
+import time
 
 class PlayerButtons:
    def __init__ (self, frame, clists, home, game, text = None):
@@ -25,8 +25,7 @@ class PlayerButtons:
       self.victoryAnthem = (self.pname == "victory")
       # timer stuff
       if self.victoryAnthem:
-         # mpv takes some time to retrieve song duration, so a sleep delay is needed
-         self.timer = Timer(self, self.frame, 1)
+         self.timer = Timer(self, self.frame)
       # check if text is none (most players)
       if self.text is None:
          self.text = "\n".join([x.lstrip() for x in self.pname.split(",")])
@@ -35,6 +34,8 @@ class PlayerButtons:
          self.reserved = True
       ## Home anthem button is hooked to this by the main client, to stop it when it starts
       self.awayButtonHook = None
+      # set while the home anthem waits for the away anthem to fade out, see handOver()
+      self.handover = None
       self.showVolume = True
       # text was specified, so this is a button for a reserved keyword
       self.colours = settings.darkColours if settings.config["dark_mode_enabled"] else settings.lightColours
@@ -68,6 +69,7 @@ class PlayerButtons:
       self.volume.configure(bg=color, activebackground=color)
 
    def resetSong (self):
+      self.handover = None
       self.clists.resetLastPlayed()
       self.playButton.configure(relief=RAISED)
       # reset the VA timer
@@ -75,6 +77,7 @@ class PlayerButtons:
          self.timer.resetTimer()
 
    def reset (self):
+      self.handover = None
       self.clists.reset()
       self.playButton.configure(relief=RAISED)
       if self.victoryAnthem:
@@ -83,42 +86,86 @@ class PlayerButtons:
    def playSong (self):
       # if home team anthem, pause away team anthem
       if self.anthem and self.awayButtonHook != None:
+         away = self.awayButtonHook.clists
+         # the away anthem is playing, or was stopped and is still fading out
+         awayPlaying = away.song is not None or (away.lastSong is not None and away.lastSong.fadeRemaining() is not None)
+         if self.clists.song is None and self.handover is None and awayPlaying:
+            self.handOver()
+            return
          self.awayButtonHook.clists.pauseSong()
          self.awayButtonHook.playButton.configure(relief=RAISED)
-         # wait until away anthem fades out completely to play home anthem
-         if self.clists.song is None and self.awayButtonHook.clists.lastSong is not None:
-            if self.awayButtonHook.clists.lastSong.fade is not None:
-               sleep(2)
       if self.clists.song is None:
-         # score points if it's a goalhorn
-         if self.pname not in reserved or self.pname == "goal":
-            self.game.score(self.pname, self.clists.home)
-         # pass it up to the list manager
-         try:
-            # if this is the first time this song is being played and it has a custom playback speed set, set the slider to that speed
-            # the playback speed will still use the exact value specified in the .4cc, it's just to show that it's been modified
-            # after the first time, if the playback speed slider has been moved, it will use the value of the slider instead
-            self.clists.playSong(self.song)
-            if not self.clists.song.customSpeed:
-               self.clists.song.song.speed = self.frame.master.playbackSpeedMenu.get()
-            self.frame.master.disablePlaybackSpeedSlider(True)
-         # no song found
-         except SongNotFound as e:
-            print(e)
-            messagebox.showwarning(e)
-            return
-         # set the button as sunken
-         self.playButton.configure(relief=SUNKEN)
+         self.handover = None
+         self.startSong()
       else:
-         # enable the playback slider and pause the song
+         # enable the playback slider and pause the song, then get it (or the next song) ready again
          self.frame.master.disablePlaybackSpeedSlider(False)
-         self.clists.pauseSong()
+         self.clists.pauseSong(callback=self.clists.prepare)
          # pause the VA timer
          if self.victoryAnthem:
             self.timer.timerPause()
          # set the button as raised
          self.playButton.configure(relief=RAISED)
 
+   def startSong (self, fadeIn = None):
+      # score points if it's a goalhorn
+      if self.pname not in reserved or self.pname == "goal":
+         self.game.score(self.pname, self.clists.home)
+      # pass it up to the list manager
+      try:
+         # if this is the first time this song is being played and it has a custom playback speed set, set the slider to that speed
+         # the playback speed will still use the exact value specified in the .4cc, it's just to show that it's been modified
+         # after the first time, if the playback speed slider has been moved, it will use the value of the slider instead
+         self.clists.playSong(self.song, fadeIn=fadeIn)
+         if not self.clists.song.customSpeed:
+            self.clists.song.song.speed = self.frame.master.playbackSpeedMenu.get()
+         self.frame.master.disablePlaybackSpeedSlider(True)
+      # no song found
+      except SongNotFound as e:
+         print(e)
+         messagebox.showwarning(e)
+         self.playButton.configure(relief=RAISED)
+         return
+      # set the button as sunken
+      self.playButton.configure(relief=SUNKEN)
+      # the next song may differ from this one (e.g. after a warcry)
+      self.clists.prepare()
+
+   def handOver (self):
+      """
+         Pauses the away anthem, if it's still playing, and starts this (home) anthem once the away
+         anthem has faded out, without blocking the UI: it starts from the fade's callback, or
+         anthem_overlap seconds before the fade ends through after(), fading in over the overlap
+         if anthem_crossfade is set.
+      """
+      away = self.awayButtonHook
+      handover = object()
+      self.handover = handover
+      def start (fadeIn = None):
+         # runs on the Tk thread; the anthem is only started once, and not at all if it was reset or pressed again
+         if self.handover is handover:
+            self.handover = None
+            self.startSong(fadeIn)
+      def faded ():
+         # the fade's callback runs on the playback dispatcher, so it hands over to the Tk thread
+         self.frame.after(0, start)
+      self.playButton.configure(relief=SUNKEN)
+      if away.clists.song is not None:
+         away.clists.pauseSong(callback=faded)
+         away.playButton.configure(relief=RAISED)
+      elif not away.clists.lastSong.afterFade(faded):
+         # the fade ended in the meantime
+         start()
+         return
+      fading = away.clists.lastSong
+      remaining = fading.fadeRemaining() if fading is not None else None
+      if remaining is None:
+         return
+      overlap = min(max(0, settings.config["anthem_overlap"]), remaining)
+      if overlap > 0:
+         fadeIn = overlap if settings.config["anthem_crossfade"] else None
+         self.frame.after(int(1000 * (remaining - overlap)), lambda: start(fadeIn))
+
    # now deprecated, but useful for bug testing
    def showSongs (self):
       text = self.text
@@ -195,43 +242,92 @@ class PlayerButtons:
                break
 
 class Timer:
-   def __init__ (self, songui, frame, delay):
+   """
+      Victory anthem timer, showing how far the playing VA is into its duration.
+
+      The position, duration, speed and pause state are observed from mpv rather than counted, so
+      the timer follows the playback speed and instructions that seek. Between mpv's reports, the
+      position is carried forward on a monotonic clock. The label is refreshed every
+      victory_timer_refresh milliseconds through after(), and nothing waits for mpv to open the file.
+   """
+   properties = ("time-pos", "duration", "speed", "pause")
+
+   def __init__ (self, songui, frame):
       self.frame = frame
       self.songui = songui
-      self.delay = delay
-      self.timer = int()
-      self.songDuration = int()
-      self.stopCounting = False
-
-   # have a sleep delay to retrieve song duration before starting up the timer
+      # mpv core being observed while the VA plays
+      self.core = None
+      # last known position in seconds and the monotonic time it was known at
+      self.report = (0.0, time.monotonic())
+      self.songDuration = 0.0
+      self.speed = 1.0
+      self.paused = False
+      self.refreshId = None
+
+   # starts following the VA that just started playing
    def retrieveSongInfo (self):
-      sleep(self.delay)
-      self.songDuration = int(self.songui.clists.song.song.duration)
-      self.timerStart()
-
-   def timerStart (self):
-      # increases the timer by the sleep delay (that occurs when starting the VA) before starting the counting loop
-      self.timer += self.delay
-      self.frame.updateSongTimer(self.timer, self.songDuration)
-      self.frame.after(1000, self.timerCountSecond)
-
-   # used to stop the timer loop
+      self.timerPause()
+      core = self.songui.clists.song.song
+      if core is None:
+         return
+      self.core = core
+      self.paused = False
+      # mpv reports the current value of every property as soon as it's observed
+      for name in Timer.properties:
+         core.observe_property(name, self._observe)
+      self.refresh()
+
+   # runs on mpv's event thread; only stores the values for refresh()
+   def _observe (self, name, value):
+      if value is None:
+         return
+      if name == "time-pos":
+         self.report = (value, time.monotonic())
+      elif name == "duration":
+         self.songDuration = value
+      elif name == "speed":
+         self.report = (self.elapsed(), time.monotonic())
+         self.speed = value
+      elif name == "pause":
+         self.report = (self.elapsed(), time.monotonic())
+         self.paused = value
+
+   # returns the VA's position in seconds, carried forward from mpv's last report while it plays
+   def elapsed (self):
+      position, reported = self.report
+      if self.core is not None and not self.paused:
+         position += (time.monotonic() - reported) * self.speed
+      if self.songDuration > 0:
+         position = min(position, self.songDuration)
+      return position
+
+   # updates the UI timer, then again after victory_timer_refresh milliseconds while the VA plays
+   def refresh (self):
+      self.frame.updateSongTimer(int(self.elapsed()), int(self.songDuration))
+      self.refreshId = self.frame.after(max(10, settings.config["victory_timer_refresh"]), self.refresh)
+
+   # stops following the VA, leaving the timer where it is
    def timerPause (self):
-      self.stopCounting = True
-
-   # updates the song timer by one second in a loop
-   def timerCountSecond (self):
-      # if the song is paused, don't loop instead and reset the bool
-      if self.stopCounting:
-         self.stopCounting = False
-      else:
-         self.timer += 1
-         self.frame.updateSongTimer(self.timer, self.songDuration)
-         self.frame.after(1000, self.timerCountSecond)
+      if self.refreshId is not None:
+         self.frame.after_cancel(self.refreshId)
+         self.refreshId = None
+      if self.core is None:
+         return
+      self.report = (self.elapsed(), time.monotonic())
+      core = self.core
+      self.core = None
+      for name in Timer.properties:
+         try:
+            core.unobserve_property(name, self._observe)
+         except Exception:
+            # the core was closed in the meantime
+            pass
 
    # resets the internal and UI timers to 0
    def resetTimer (self):
-      self.timer = 0
+      self.timerPause()
+      self.report = (0.0, time.monotonic())
+      self.songDuration = 0.0
       self.frame.updateSongTimer(0, 0)
 
 class TeamMenuLegacy (Frame):
@@ -307,15 +403,12 @@ class TeamMenuLegacy (Frame):
       # if a boosted song is currently playing, update its af filter live
       for button in self.buttons:
          if button.clists.song is not None and button.clists.song.louder:
-            if button.clists.song.normalize_gain is not None:
-               total_gain = button.clists.song.normalize_gain + self.boostValue
-               button.clists.song.song.af = "volume={:.1f}dB,alimiter=limit=0.95".format(total_gain)
+            button.clists.song.applyFilters()
       # also update a currently playing louder-marked chant
       if hasattr(self.master, 'chantsManager') and self.master.chantsManager is not None:
          chant = self.master.chantsManager.activeChant
-         if chant is not None and hasattr(chant, 'louder') and chant.louder and chant.normalize_gain is not None:
-            total_gain = chant.normalize_gain + self.boostValue
-            chant.song.af = "volume={:.1f}dB,alimiter=limit=0.95".format(total_gain)
+         if chant is not None and hasattr(chant, 'louder') and chant.louder:
+            chant.applyFilters()
 
    def applyBoost (self, boostDb):
       for playerList in self.players.values():
@@ -391,10 +484,39 @@ class TeamMenuLegacy (Frame):
       for button in self.buttons:
          button.reset()
 
+   # gets as many of the goalhorns and the victory anthem as the mpv pool has room for ready to play
+   # as soon as they're pressed; returns the room left (see Rigdio.prepareSongs(), which does the anthems)
+   def prepare (self, room):
+      # victory anthems are played last, so they come last
+      for button in sorted(self.buttons, key=lambda button: button.victoryAnthem):
+         if room <= 0:
+            break
+         if button is not self.anthemButton and button.clists.prepare():
+            room -= 1
+      return room
+
+   # resolves static conditions (home, opponent, match type) for every button
+   def foldConditions (self, game):
+      dropped = 0
+      for button in self.buttons:
+         dropped += button.clists.fold(game)
+      print("Resolved static conditions for /{}/; {} song(s) can't play in this match.".format(self.tname, dropped))
+
    def goNuclear(self):
       for playerButton in self.buttons:
          playerButton.playSong()
 
+   def chaosSongs(self):
+      """Returns the song every button would play now, for the chaoshorn mixer (see legacy.ChaosMixer)."""
+      songs = [playerButton.clists.getSong(playerButton.song) for playerButton in self.buttons]
+      return [song for song in songs if song is not None]
+
+   def chaosScore(self):
+      # scores every player, as pressing every button in goNuclear() does
+      for playerButton in self.buttons:
+         if playerButton.pname not in reserved or playerButton.pname == "goal":
+            self.game.score(playerButton.pname, playerButton.clists.home)
+
    def stopNuclear(self):
       for playerButton in self.buttons:
          playerButton.playSong()